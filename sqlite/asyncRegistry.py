@@ -0,0 +1,131 @@
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+##~ Copyright (C) 2002-2007  TechGame Networks, LLC.              ##
+##~                                                               ##
+##~ This library is free software; you can redistribute it        ##
+##~ and/or modify it under the terms of the BSD style License as  ##
+##~ found in the LICENSE file included with this distribution.    ##
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Imports
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import sys
+
+# Needs an asyncio event loop: on python 2 that is trollius, the asyncio
+# backport, which is not otherwise a dependency of this package and must
+# be installed separately.
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from .registry import SQLObjectRegistry
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Definitions
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class AsyncSQLObjectRegistry(SQLObjectRegistry):
+    """SQLObjectRegistry whose load, store, storeAll, commit, gcCollect,
+    remove and fault return asyncio futures of the event loop instead of
+    blocking it on the command thread.
+
+    Commands issued during one pass of the loop are run by a single
+    command thread wakeup, and their results delivered by a single loop
+    callback, so asyncio.gather over many loads costs one round trip.
+
+    The blocking methods of SQLObjectRegistry remain available, for use
+    off the loop.
+
+    Requires asyncio, or on python 2 the trollius backport."""
+
+    def __init__(self, filename, dbid=None, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self._abatch = []
+        SQLObjectRegistry.__init__(self, filename, dbid)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def load(self, oid, default=None, depth=1):
+        return self._tasync(self._load.loadOid, oid, default, depth)
+    def store(self, obj, urlpath=None):
+        return self._tasync(self._save.store, obj, urlpath)
+    def storeAll(self, iter, named=None):
+        return self._tasync(self._save.storeAll, iter, named)
+    def remove(self, obj):
+        return self._tasync(self._save.remove, obj)
+    def commit(self):
+        return self._tasync(self._save.commit)
+    def gcCollect(self):
+        return self._tasync(self.stg.gcCollect)
+
+    def fault(self, proxy):
+        """Loads the object behind an ObjOidProxy or ObjOidRef, the
+        awaitable equivalent of touching the proxy; other objects are
+        returned as they are"""
+        getProxy = getattr(proxy, '__getProxy__', None)
+        if getProxy is None:
+            ref = proxy
+        else:
+            oidRef = getProxy()
+            ref = oidRef.ref
+            if ref is None:
+                return self._tasync(oidRef.load)
+
+        future = asyncio.Future(loop=self.loop)
+        future.set_result(ref)
+        return future
+
+    # the blocking methods, for use off the event loop
+    loadBlocking = SQLObjectRegistry.load
+    storeBlocking = SQLObjectRegistry.store
+    commitBlocking = SQLObjectRegistry.commit
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Event loop bridge
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def _tasync(self, fn, *args, **kw):
+        future = asyncio.Future(loop=self.loop)
+        batch = self._abatch
+        if not batch:
+            self.loop.call_soon(self._asubmit)
+        batch.append((future, fn, args, kw))
+        return future
+
+    def _asubmit(self):
+        batch = self._abatch
+        self._abatch = []
+        self._tsend(self._t_runBatch, batch)
+
+    def _t_runBatch(self, batch):
+        results = []
+        for future, fn, args, kw in batch:
+            if future.cancelled():
+                results.append(None)
+                continue
+            try:
+                results.append((fn(*args, **kw), None))
+            except Exception:
+                results.append((None, sys.exc_info()))
+        self.loop.call_soon_threadsafe(self._aresolve, batch, results)
+
+    def _aresolve(self, batch, results):
+        for (future, fn, args, kw), r in zip(batch, results):
+            if r is None or future.cancelled():
+                continue
+            result, excInfo = r
+            if excInfo is not None:
+                self._asetException(future, excInfo)
+            else: future.set_result(result)
+
+    def _asetException(self, future, excInfo):
+        # trollius keeps the traceback of the exception being handled, so
+        # it is raised again here to carry the command thread's traceback
+        try:
+            raise excInfo[0], excInfo[1], excInfo[2]
+        except Exception:
+            future.set_exception(excInfo[1])
@@ -0,0 +1,354 @@
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+##~ Copyright (C) 2002-2007  TechGame Networks, LLC.              ##
+##~                                                               ##
+##~ This library is free software; you can redistribute it        ##
+##~ and/or modify it under the terms of the BSD style License as  ##
+##~ found in the LICENSE file included with this distribution.    ##
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Imports
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+from bisect import bisect_left, bisect_right
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Definitions
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class BTreeBucket(object):
+    """Leaf of a PersistentBTree: sorted keys and their values"""
+    __slots__ = ('keys', 'values', '_oid', '_dirty', '__weakref__')
+    stgKind = 'btreeBucket'
+
+    def __init__(self, keys, values, oid=None):
+        self.keys = keys
+        self.values = values
+        self._oid = oid
+        self._dirty = oid is None
+
+    def __repr__(self):
+        return '<%s oid: %r len: %s>' % (self.__class__.__name__, self._oid, len(self.keys))
+
+class BTreeNode(object):
+    """Inner node of a PersistentBTree.  keys[i] is the least key under
+    children[i+1]; a child not yet loaded is held by its oid."""
+    __slots__ = ('keys', 'children', '_oid', '_dirty', '__weakref__')
+    stgKind = 'btreeNode'
+
+    def __init__(self, keys, children, oid=None):
+        self.keys = keys
+        self.children = children
+        self._oid = oid
+        self._dirty = oid is None
+
+    def __repr__(self):
+        return '<%s oid: %r len: %s>' % (self.__class__.__name__, self._oid, len(self.children))
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class PersistentBTree(object):
+    """Sorted mapping stored as a tree of buckets, each under an oid of
+    its own.  Once loaded, only the buckets on the path to a key are
+    loaded for a lookup or change, and only changed buckets are written
+    on commit.  Range scans load the buckets holding the range.
+
+    Keys must be mutually ordered and storable; None is not a valid key,
+    being used for an open bound in the range methods."""
+
+    maxBucketSize = 128
+    maxNodeSize = 128
+
+    _oid = None
+    _loader = None
+    _dirtyOids = None
+
+    def __init__(self, items=None):
+        self._root = BTreeBucket([], [])
+        self._size = 0
+        self._dirty = True
+        if items is not None:
+            self.update(items)
+
+    def _setLoaded(self, loader, dirtyOids, oid, root, size):
+        self._loader = loader
+        self._dirtyOids = dirtyOids
+        self._oid = oid
+        self._root = root
+        self._size = size
+        self._dirty = False
+
+    def __repr__(self):
+        return '<%s oid: %r len: %s>' % (self.__class__.__name__, self._oid, self._size)
+
+    def __getstate__(self):
+        raise RuntimeError("PersistentBTree is stored by bucket, not by state: %r" % (self,))
+
+    #~ Mapping ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def __len__(self):
+        return self._size
+
+    def __nonzero__(self):
+        return self._size > 0
+
+    def __getitem__(self, key):
+        bucket = self._findBucket(key)
+        i = bisect_left(bucket.keys, key)
+        if i < len(bucket.keys) and bucket.keys[i] == key:
+            return bucket.values[i]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        bucket = self._findBucket(key)
+        i = bisect_left(bucket.keys, key)
+        return i < len(bucket.keys) and bucket.keys[i] == key
+    has_key = __contains__
+
+    def __setitem__(self, key, value):
+        if key is None:
+            raise KeyError("None is not a valid PersistentBTree key")
+
+        path, bucket = self._findPath(key)
+        keys = bucket.keys
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            if bucket.values[i] is not value:
+                bucket.values[i] = value
+                self._touch(bucket)
+            return
+
+        keys.insert(i, key)
+        bucket.values.insert(i, value)
+        self._touch(bucket)
+        self._size += 1
+        self._touch(self)
+
+        if len(keys) > self.maxBucketSize:
+            self._split(path, bucket)
+
+    def __delitem__(self, key):
+        path, bucket = self._findPath(key)
+        keys = bucket.keys
+        i = bisect_left(keys, key)
+        if i >= len(keys) or keys[i] != key:
+            raise KeyError(key)
+
+        del keys[i]
+        del bucket.values[i]
+        self._touch(bucket)
+        self._size -= 1
+        self._touch(self)
+
+        if not keys and path:
+            self._removeEmpty(path)
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def update(self, items):
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        for key, value in items:
+            self[key] = value
+
+    def clear(self):
+        self._root = BTreeBucket([], [])
+        self._size = 0
+        self._touch(self)
+
+    #~ Ordered access ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iteritems(self, minKey=None, maxKey=None):
+        """Items with minKey <= key <= maxKey in key order; None leaves a
+        bound open"""
+        return self._iterRange(self._rootBucket(), minKey, maxKey)
+    def iterkeys(self, minKey=None, maxKey=None):
+        return (k for k, v in self.iteritems(minKey, maxKey))
+    def itervalues(self, minKey=None, maxKey=None):
+        return (v for k, v in self.iteritems(minKey, maxKey))
+
+    def items(self, minKey=None, maxKey=None):
+        return list(self.iteritems(minKey, maxKey))
+    def keys(self, minKey=None, maxKey=None):
+        return list(self.iterkeys(minKey, maxKey))
+    def values(self, minKey=None, maxKey=None):
+        return list(self.itervalues(minKey, maxKey))
+
+    def minKey(self):
+        node = self._rootBucket()
+        while type(node) is BTreeNode:
+            node = self._child(node, 0)
+        if not node.keys:
+            raise ValueError("empty tree")
+        return node.keys[0]
+
+    def maxKey(self):
+        node = self._rootBucket()
+        while type(node) is BTreeNode:
+            node = self._child(node, len(node.children)-1)
+        if not node.keys:
+            raise ValueError("empty tree")
+        return node.keys[-1]
+
+    def _iterRange(self, node, lo, hi):
+        keys = node.keys
+        if type(node) is BTreeNode:
+            i = 0 if lo is None else bisect_right(keys, lo)
+            j = len(keys) if hi is None else bisect_right(keys, hi)
+            for c in xrange(i, j+1):
+                for item in self._iterRange(self._child(node, c), lo, hi):
+                    yield item
+        else:
+            i = 0 if lo is None else bisect_left(keys, lo)
+            j = len(keys) if hi is None else bisect_right(keys, hi)
+            values = node.values
+            for c in xrange(i, j):
+                yield keys[c], values[c]
+
+    #~ Buckets ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def unloadBuckets(self):
+        """Drops the loaded buckets whose changes are all written, to be
+        loaded again when next reached; returns how many were dropped"""
+        dirtyOids = self._dirtyOids or ()
+        root = self._root
+        if type(root) is BTreeNode:
+            return self._unloadChildren(root, dirtyOids)
+        return 0
+
+    def _unloadChildren(self, node, dirtyOids):
+        n = 0
+        children = node.children
+        for i, child in enumerate(children):
+            if type(child) in (int, long):
+                continue
+            if type(child) is BTreeNode:
+                n += self._unloadChildren(child, dirtyOids)
+            if child._dirty or child._oid is None or child._oid in dirtyOids:
+                continue
+            if type(child) is BTreeNode and not self._isUnloaded(child):
+                continue
+            children[i] = child._oid
+            n += 1
+        return n
+
+    def _isUnloaded(self, node):
+        for child in node.children:
+            if type(child) not in (int, long):
+                return False
+        return True
+
+    def _rootBucket(self):
+        root = self._root
+        if type(root) in (int, long):
+            root = self._loadBucket(root)
+            self._root = root
+        return root
+
+    def _child(self, node, i):
+        child = node.children[i]
+        if type(child) in (int, long):
+            child = self._loadBucket(child)
+            node.children[i] = child
+        return child
+
+    def _loadBucket(self, oid):
+        loader = self._loader
+        if loader is None:
+            raise RuntimeError("Bucket %r of %r is not loaded" % (oid, self))
+        return loader.loadBucket(oid)
+
+    def _findBucket(self, key):
+        node = self._rootBucket()
+        while type(node) is BTreeNode:
+            node = self._child(node, bisect_right(node.keys, key))
+        return node
+
+    def _findPath(self, key):
+        path = []
+        node = self._rootBucket()
+        while type(node) is BTreeNode:
+            i = bisect_right(node.keys, key)
+            path.append((node, i))
+            node = self._child(node, i)
+        return path, node
+
+    def _touch(self, obj):
+        obj._dirty = True
+        dirtyOids = self._dirtyOids
+        if dirtyOids is not None and obj._oid is not None:
+            dirtyOids.add(obj._oid)
+
+    def _split(self, path, node):
+        while 1:
+            keys = node.keys
+            mid = len(keys) // 2
+            sep = keys[mid]
+            if type(node) is BTreeNode:
+                other = BTreeNode(keys[mid+1:], node.children[mid+1:])
+                del keys[mid:]
+                del node.children[mid+1:]
+            else:
+                other = BTreeBucket(keys[mid:], node.values[mid:])
+                del keys[mid:]
+                del node.values[mid:]
+            self._touch(node)
+
+            if not path:
+                self._root = BTreeNode([sep], [node, other])
+                self._touch(self)
+                return
+
+            parent, i = path.pop()
+            parent.keys.insert(i, sep)
+            parent.children.insert(i+1, other)
+            self._touch(parent)
+            if len(parent.children) <= self.maxNodeSize:
+                return
+            node = parent
+
+    def _removeEmpty(self, path):
+        # drops the emptied child from its parents, then any root node
+        # left with a single child
+        while path:
+            parent, i = path.pop()
+            del parent.children[i]
+            if parent.keys:
+                del parent.keys[max(i-1, 0)]
+            self._touch(parent)
+            if parent.children:
+                break
+        else:
+            self._root = BTreeBucket([], [])
+            self._touch(self)
+            return
+
+        root = self._rootBucket()
+        while type(root) is BTreeNode and len(root.children) == 1:
+            root = self._child(root, 0)
+            self._root = root
+            self._touch(self)
@@ -11,19 +11,90 @@
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 import sys
-from threading import currentThread, Thread
+import time
+from threading import currentThread, Thread, Lock
 import Queue
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~ Definitions 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+class CommandFuture(object):
+    """The pending result of one command run on the command thread"""
+
+    _result = None
+    _excInfo = None
+
+    def __init__(self):
+        self._done = False
+        self._callbacks = []
+        self._cbLock = Lock()
+        # held until the result is set; waiting is a blocking acquire
+        self._lock = Lock()
+        self._lock.acquire()
+
+    def done(self):
+        return self._done
+
+    def wait(self):
+        if not self._done:
+            self._lock.acquire()
+            self._lock.release()
+
+    def result(self):
+        self.wait()
+        excInfo = self._excInfo
+        if excInfo is not None:
+            raise excInfo[0], excInfo[1], excInfo[2]
+        return self._result
+
+    def exception(self):
+        self.wait()
+        if self._excInfo is not None:
+            return self._excInfo[1]
+
+    def addDoneCallback(self, fn):
+        """fn(future) is called on the command thread once done, or right
+        away if the future is done already"""
+        self._cbLock.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._cbLock.release()
+        fn(self)
+
+    def setResult(self, result):
+        self._result = result
+        self._setDone()
+
+    def setException(self, excInfo):
+        self._excInfo = excInfo
+        self._setDone()
+
+    def _setDone(self):
+        self._cbLock.acquire()
+        try:
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._cbLock.release()
+        self._lock.release()
+        for fn in callbacks:
+            fn(self)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
 class ThreadedCommands(object):
     timeout = None
+    _idleTick = object()
+
     def __init__(self, timeout):
         self.timeout = timeout
         self.qCommand = Queue.Queue()
-        self.qResult = Queue.Queue()
+        self._nCommands = 0
 
         self._onIdle = []
         self._onClose = []
@@ -34,6 +105,11 @@ class ThreadedCommands(object):
         t.setDaemon(True)
         t.start()
 
+        if timeout is not None:
+            t = Thread(target=self._t_clock)
+            t.setDaemon(True)
+            t.start()
+
     def connect(self, onIdle, onClose):
         self._onIdle.append(onIdle)
         self._onClose.append(onClose)
@@ -46,57 +122,59 @@ class ThreadedCommands(object):
         if currentThread() is self._thread:
             return fn(*args, **kw)
 
-        self.qCommand.put((False, fn, args, kw))
+        self.qCommand.put((None, fn, args, kw))
         return None
 
+    def submit(self, fn, *args, **kw):
+        """Queues fn to run on the command thread, returning a CommandFuture
+        for its result without waiting on it"""
+        future = CommandFuture()
+        if currentThread() is self._thread:
+            self._t_run(future, fn, args, kw)
+        else:
+            self.qCommand.put((future, fn, args, kw))
+        return future
+
     def call(self, fn, *args, **kw):
         if currentThread() is self._thread:
             return fn(*args, **kw)
-
-        self.qCommand.put((True, fn, args, kw))
-
-        complete, r = self.qResult.get()
-        if not complete:
-            raise r
-        return r
+        return self.submit(fn, *args, **kw).result()
 
     def close(self):
         if currentThread() is self._thread:
             raise RuntimeError("Do not close command queue within command queue")
 
-        self.qCommand.put((True, None, None, None))
-        complete, r = self.qResult.get()
-        if not complete:
-            raise r
-        return r
+        future = CommandFuture()
+        self.qCommand.put((future, None, None, None))
+        return future.result()
 
     def _t_process(self):
+        future = None
         try:
             qCommand = self.qCommand
-            qResult = self.qResult
             Empty = Queue.Empty
+            pending = False
             while 1:
-                try:
-                    isCall, fn, args, kw = qCommand.get(True, self.timeout)
-
-                except Empty:
-                    self._t_idle()
+                if pending:
+                    # idle work continues until a command is queued
+                    try:
+                        item = qCommand.get_nowait()
+                    except Empty:
+                        pending = self._t_idle()
+                        continue
+                else: item = qCommand.get()
+
+                if item is self._idleTick:
+                    pending = self._t_idle()
                     continue
 
+                future, fn, args, kw = item
                 if fn is None:
                     break
 
-                try:
-                    r = fn(*args, **kw)
-                except Exception, e:
-                    sys.excepthook(*sys.exc_info())
-                    print
-                    print
-                    if isCall: 
-                        qResult.put((False, e))
-                else:
-                    if isCall: 
-                        qResult.put((True, r))
+                self._nCommands += 1
+                self._t_run(future, fn, args, kw)
+                future = None
 
         except KeyboardInterrupt:
             return
@@ -104,12 +182,45 @@ class ThreadedCommands(object):
         finally:
             self._t_close()
 
-        if isCall: 
-            qResult.put((True, None))
+        if future is not None:
+            future.setResult(None)
+
+    def _t_run(self, future, fn, args, kw):
+        try:
+            r = fn(*args, **kw)
+        except Exception, e:
+            excInfo = sys.exc_info()
+            sys.excepthook(*excInfo)
+            print
+            print
+            if future is not None:
+                future.setException(excInfo)
+        else:
+            if future is not None:
+                future.setResult(r)
+
+    def _t_clock(self):
+        # queues an idle tick after each timeout without commands, so the
+        # command thread itself can block on the queue without polling
+        last = self._nCommands
+        while self._thread is not None:
+            time.sleep(self.timeout)
+            if last == self._nCommands and self.qCommand.empty():
+                self.qCommand.put(self._idleTick)
+            last = self._nCommands
 
     def _t_idle(self):
+        # idle hooks return True when they have more work pending
+        pending = False
         for fn in self._onIdle:
-            fn()
+            try:
+                if fn():
+                    pending = True
+            except Exception:
+                sys.excepthook(*sys.exc_info())
+                print
+                print
+        return pending
 
     def _t_close(self):
         for fn in self._onClose:
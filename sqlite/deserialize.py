@@ -10,19 +10,53 @@
 #~ Imports 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+import gc
 import sys
+import types
 import weakref
 import pickle 
-from .proxy import ObjOidRef, ObjOidProxy
+from .lruMapping import LRUMapping
+from .proxy import ObjOidRef, ObjOidContainerRef, ObjOidProxy, ObjOidContainerProxy
+from .oidMappings import approxSizeOf, getSizeOf
+from .btree import BTreeBucket, BTreeNode
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~ Definitions 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 class ObjectDeserializer(object):
+    # Mappings hops staged per level of load depth.  An object is one hop
+    # from its reduction state and two from the values held in it; the
+    # extra hops stage rows for the proxies faulted in after the load.
+    prefetchHopsPerDepth = 2
+    prefetchHops = 16
+
+    # Unloaded lists, sets and dicts are proxied by ObjOidContainerProxy,
+    # answering len, in, indexing and iteration a page of rows at a time.
+    lazyContainers = True
+    containerPageSize = 1000
+
+    # When True, a faulted proxy is replaced by its target in the lists,
+    # dicts and instance __dict__s loaded holding it, so later access
+    # costs nothing over a plain object.  Mutations of a swizzled object
+    # bypass the proxy write barrier: with commitDirtyOnly they need an
+    # explicit markDirty().
+    swizzleProxies = False
+
+    # When True, an ObjOidRef holds its proxy directly instead of through
+    # a weakref, saving the weakref per unloaded object; ref and proxy are
+    # then freed together by the cycle collector.
+    singleProxy = False
+
     def __init__(self, reg):
         self._transitiveOids = set()
         self._deferredRefs = {}
+        # oid -> (oidRef, stg_kind, otype, nBytes) of faulted proxies, in
+        # the order they were faulted
+        self._faulted = LRUMapping()
+        self._faultedBytes = 0
+        # id_otype -> otype for the ids held by ObjOidRefs
+        self._otypeNames = {}
 
         stg = reg.stg
         self.reg = reg
@@ -37,6 +71,7 @@ class ObjectDeserializer(object):
         raise RuntimeError("Tried to store storage mechanism: %r" % (self,))
 
     def close(self):
+        self._faulted.clear()
         self.stg = None
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -60,10 +95,12 @@ class ObjectDeserializer(object):
         if cr is not None:
             return cr
 
+        self.prefetch(oid, depth)
         stg_kind, otype = self.stg.getOidInfo(oid)
         result = self.loadEntry((oid, stg_kind, otype), depth)
 
         self._loadDeferred()
+        self._trimLoaded()
         return result
 
     def loadUrlPath(self, urlPath, default=None, depth=1):
@@ -75,12 +112,21 @@ class ObjectDeserializer(object):
         if entry is None:
             return default
 
+        self.prefetch(entry[0], depth)
         result = self.loadEntry(entry, depth)
         self.oidToObj.addByLoad(urlPath, result)
 
         self._loadDeferred()
+        self._trimLoaded()
         return result
 
+    def _trimLoaded(self):
+        save = self.reg._save
+        if save.commitDirtyOnly:
+            self.objToOid.releasePinned(self.stg.dirtyOids)
+        self.oidToObj.trimResidency(self.objToOid, save)
+        self.pageOut()
+
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     #~ Storage by Type
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -104,6 +150,8 @@ class ObjectDeserializer(object):
         oid, stg_kind, otype = entry
 
         if not oid:
+            if stg_kind == 'inline':
+                return otype
             return None
 
         cr = self.oidToObj[oid]
@@ -116,9 +164,11 @@ class ObjectDeserializer(object):
         fn, useProxy = self._loadByKindMap[stg_kind]
 
         if useProxy:
-            objRef = ObjOidRef(self, oid, otype)
+            if self.lazyContainers and stg_kind in ('list', 'map'):
+                objRef = ObjOidContainerRef(self, oid, otype)
+            else: objRef = ObjOidRef(self, oid, otype)
             objRef = self.onLoadedObjRef(oid, objRef)
-            result = objRef.proxy()
+            result = objRef.proxy(self.singleProxy)
         else:
             result = fn(self, oid, stg_kind, otype, depth-1)
 
@@ -128,13 +178,114 @@ class ObjectDeserializer(object):
             tempOids.discard(oid)
         return result
 
+    def markDirtyOid(self, oid):
+        """Write barrier entry point used by ObjOidRef; safe from any thread"""
+        self.stg.dirtyOids.add(oid)
+
     def loadOidRef(self, oidRef):
         """Used by ObjOidRef to load state"""
         oid = oidRef.oid
         depth, oidRef = self._deferredRefs.pop(oid, (1, oidRef))
-        return self.reg._tcall(self._loadAs_OidRef, oidRef, oid, depth)
+        return self.reg._tcall(self._faultOidRef, oidRef, oid, depth)
+
+    def loadBucket(self, oid):
+        """Used by PersistentBTree to load one of its buckets"""
+        return self.reg._tcall(self._loadBucket, oid)
+    def _loadBucket(self, oid):
+        stg_kind, otype = self.stg.getOidInfo(oid)
+        return self.loadEntry((oid, stg_kind, otype), 0)
+
+    def otypeId(self, otype):
+        """Returns the storage's integer id for otype, used by ObjOidRef to
+        hold it compactly, or otype itself if it has none"""
+        idOType = self.stg.otypeMap.get(otype)
+        if idOType is None:
+            return otype
+        self._otypeNames[idOType] = otype
+        return idOType
+    def otypeForId(self, idOType):
+        if isinstance(idOType, basestring):
+            return idOType
+        return self._otypeNames[idOType]
+    def _faultOidRef(self, oidRef, oid, depth):
+        obj = self._loadAs_OidRef(oidRef, oid, depth)
+        self.pageOut()
+        return obj
     
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Lazy containers, used by ObjOidContainerProxy
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def containerLen(self, oidRef):
+        return self.reg._tcall(self.stg.getContainerLen, oidRef.oid)
+
+    def containerPage(self, oidRef, offset, count):
+        """Loads count values of a list or set, or keys of a dict, starting
+        at offset in stored order"""
+        return self.reg._tcall(self._containerPage, oidRef, offset, count)
+    def _containerPage(self, oidRef, offset, count):
+        if oidRef.otype == 'dict':
+            entries = self.stg.getMappingKeys(oidRef.oid, offset, count)
+        else: 
+            entries = self.stg.getOrderedSlice(oidRef.oid, offset, count)
+        load = self.loadEntry
+        return [load(e, 0) for e in entries]
+
+    def containerLookup(self, oidRef, key):
+        """Returns (True, value) for a key of a dict, (False, None) for a
+        missing key, or None if key cannot be matched without a full load"""
+        return self.reg._tcall(self._containerLookup, oidRef, key)
+    def _containerLookup(self, oidRef, key):
+        ref = self._refForLookup(key)
+        if ref is None:
+            return None
+
+        entry = self.stg.getMappingValue(oidRef.oid, ref)
+        if entry is not None:
+            return (True, self.loadEntry(entry, 0))
+        if self._isConclusive(key, ref):
+            return (False, None)
+
+    def containerContains(self, oidRef, value):
+        """Returns whether a list or set holds value, or None if value cannot
+        be matched without a full load"""
+        return self.reg._tcall(self._containerContains, oidRef, value)
+    def _containerContains(self, oidRef, value):
+        ref = self._refForLookup(value)
+        if ref is None:
+            return None
+        if self.stg.hasOrderedValue(oidRef.oid, ref):
+            return True
+        if self._isConclusive(value, ref):
+            return False
+
+    def _isConclusive(self, value, ref):
+        # inline scalars are matched by value across their numeric or text
+        # types, so a miss is final; an object matched by oid may still
+        # compare equal to some other member
+        return value is None or type(ref) is tuple
+
+    def _refForLookup(self, value):
+        save = self.reg._save
+        ref = save.inlineRef(value)
+        if ref is None:
+            ref = save._findOid(value)
+        if ref is None and type(value) in save._inlineTypes:
+            value_type = type(value).__name__
+            ref = self.stg.findLiteral(value, 
+                    self.stg.hashLiteral(value, value_type), value_type)
+        return ref
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def prefetchLevels(self, depth):
+        return self.prefetchHopsPerDepth*max(depth, 1) + self.prefetchHops
+
+    def prefetch(self, oid, depth):
+        return self.stg.prefetch(oid, self.prefetchLevels(depth))
+
     def _loadAs_OidRef(self, oidRef, oid, depth):
+        self.prefetch(oid, depth)
         stg_kind, otype = self.stg.getOidInfo(oid)
         fn, useProxy = self._loadByKindMap[stg_kind]
         if useProxy is False:
@@ -142,9 +293,181 @@ class ObjectDeserializer(object):
 
         obj = fn(self, oid, stg_kind, otype, depth-1)
         self.setOidForObj(obj, otype, oid, True)
+        self.reg._save.recordLoaded(oid, stg_kind, otype, obj)
         oidRef.ref = obj
+        if oidRef.parents is not None:
+            self._swizzle(oidRef, obj)
+
+        entry = self._faulted.pop(oid, None)
+        if entry is not None:
+            self._faultedBytes -= entry[-1]
+        nBytes = approxSizeOf(obj)
+        self._faulted[oid] = (oidRef, stg_kind, otype, nBytes)
+        self._faultedBytes += nBytes
         return obj
 
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Swizzling of faulted proxies
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    _proxyTypes = (ObjOidProxy, ObjOidContainerProxy)
+    def _noteParent(self, oid, values):
+        """Records oid as holding each unloaded proxy among values"""
+        proxyTypes = self._proxyTypes
+        for v in values:
+            if type(v) in proxyTypes:
+                oidRef = v.__getProxy__()
+                if oidRef.ref is None:
+                    if oidRef.parents is None:
+                        oidRef.parents = [oid]
+                    elif oid not in oidRef.parents:
+                        oidRef.parents.append(oid)
+
+    def _swizzle(self, oidRef, obj):
+        parents = oidRef.parents
+        oidRef.parents = None
+        pxy = oidRef.liveProxy()
+        if pxy is None:
+            return
+
+        peek = self.oidToObj.peek
+        proxyTypes = self._proxyTypes
+        for parentOid in parents:
+            parent = peek(parentOid)
+            if parent is None or type(parent) in proxyTypes:
+                continue
+
+            if isinstance(parent, list):
+                for i, v in enumerate(parent):
+                    if v is pxy:
+                        parent[i] = obj
+            if isinstance(parent, dict):
+                self._swizzleValues(parent, pxy, obj)
+            ns = getattr(parent, '__dict__', None)
+            if type(ns) is dict:
+                self._swizzleValues(ns, pxy, obj)
+
+    def _swizzleValues(self, d, pxy, obj):
+        for k, v in d.items():
+            if v is pxy:
+                d[k] = obj
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Page-out of faulted proxies
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def pageOut(self, budget=None):
+        """Unloads the targets of faulted proxies, least recently faulted
+        first, until their approximate bytes are within budget -- the
+        registry's memoryBudget by default.  Only targets that are clean
+        and not referred to from outside the maps are unloaded; their
+        proxies fault them in again when next touched."""
+        if budget is None:
+            budget = self.reg.memoryBudget
+            if budget is None:
+                return 0
+
+        faulted = self._faulted
+        save = self.reg._save
+        oidToObj = self.oidToObj
+        objToOid = self.objToOid
+
+        nUnloaded = 0
+        # the most recent fault is left alone, lest a target larger than
+        # the budget be unloaded as soon as it is loaded
+        nCandidates = len(faulted) - 1
+        while self._faultedBytes > budget and nCandidates > 0:
+            nCandidates -= 1
+            oid, entry = faulted.popitem(False)
+            oidRef, stg_kind, otype, nBytes = entry
+            obj = oidRef.ref
+            if obj is None or oidToObj.peek(oid) is not obj:
+                self._faultedBytes -= nBytes
+                continue
+
+            if save.commitDirtyOnly:
+                clean = oid not in save.dirtyOids
+            else: clean = save.isUnchanged(oid, stg_kind, otype, obj)
+
+            cache = oidToObj.cache
+            cached = cache is not None and cache.holds(oid, obj)
+            # references: oidRef, obj, the argument, and those of the maps
+            # and the cache
+            if not clean or sys.getrefcount(obj) > (3 
+                    + (dict.get(oidToObj, oid) is obj)
+                    + objToOid.isRetained(obj) + cached):
+                # dirty or still in use; counts as recently faulted
+                faulted[oid] = entry
+                continue
+
+            if cached:
+                cache.discard(oid)
+            oidRef.ref = None
+            oidToObj.remove(oid)
+            objToOid.remove(obj)
+            del obj
+            self._faultedBytes -= nBytes
+            nUnloaded += 1
+
+            # loads of oid are answered by the proxy again
+            pxy = oidRef.liveProxy()
+            if pxy is not None:
+                self.setOidForObj(pxy, otype, oid, True)
+        return nUnloaded
+
+    def faultedBytes(self):
+        """Approximate bytes held by the targets of faulted proxies"""
+        return self._faultedBytes
+
+    _residentSkipTypes = (type, types.ClassType, types.ModuleType, 
+        types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+    def residentBytes(self):
+        """Returns {urlpath: approximate bytes} of the objects in memory
+        reachable from each root loaded by urlpath.  Unloaded proxies are
+        not faulted, and objects reachable from several roots count
+        toward each."""
+        return dict((urlpath, self._residentBytesFrom(root))
+            for urlpath, root in self.oidToObj.urlPathItems())
+
+    def _residentBytesFrom(self, root):
+        proxyTypes = (ObjOidProxy, ObjOidContainerProxy)
+        skipTypes = self._residentSkipTypes
+        seen = set()
+        work = [root]
+        nBytes = 0
+        while work:
+            obj = work.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+
+            if type(obj) in proxyTypes:
+                target = obj.__proxyOrNone__()
+                if target is not None:
+                    work.append(target)
+                else:
+                    # follow the stored rows to what is loaded below
+                    work.extend(self._loadedChildrenOf(obj.__getProxy__().oid))
+                continue
+            if isinstance(obj, skipTypes):
+                continue
+
+            nBytes += getSizeOf(obj)
+            work.extend(gc.get_referents(obj))
+        return nBytes
+
+    def _loadedChildrenOf(self, oid):
+        stg_kind, otype = self.stg.getOidInfo(oid)
+        if stg_kind == 'list':
+            entries = self.stg.getOrdered(oid) or ()
+        elif stg_kind in ('map', 'obj'):
+            entries = [e for item in self.stg.getMapping(oid) or () for e in item]
+        else: return []
+
+        peek = self.oidToObj.peek
+        children = [peek(e[0]) for e in entries if e[0]]
+        return [c for c in children if c is not None]
+
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def regKind(kind, useProxy, map=_loadByKindMap):
@@ -199,6 +522,8 @@ class ObjectDeserializer(object):
         result = self._stg_getOrdered(oid, depth)
         if otype == 'list':
             result = list(result)
+            if self.swizzleProxies:
+                self._noteParent(oid, result)
         elif otype == 'set':
             result = set(result)
         elif otype == 'frozenset':
@@ -213,11 +538,47 @@ class ObjectDeserializer(object):
         result = self._stg_getMapping(oid, depth)
         if otype == 'dict':
             result = dict(result)
+            if self.swizzleProxies:
+                self._noteParent(oid, result.itervalues())
 
         else: assert False, (stg_kind, otype, result)
 
         return result
 
+    @regKind('btree', False)
+    def _loadAs_btree(self, oid, stg_kind, otype, depth):
+        header = dict((self.loadEntry(k, 0), v) 
+                for k, v in self.stg.getMapping(oid))
+        size = self.loadEntry(header['size'], 0)
+
+        klass = self.lookupOType(otype)
+        tree = klass.__new__(klass)
+        # the root bucket is loaded on first use
+        tree._setLoaded(self, self.stg.dirtyOids, oid, header['root'][0], size)
+        self.reg._save.recordLoaded(oid, stg_kind, otype, tree)
+        return tree
+
+    @regKind('btreeBucket', False)
+    def _loadAs_btreeBucket(self, oid, stg_kind, otype, depth):
+        load = self.loadEntry
+        entries = self.stg.getOrdered(oid)
+        bucket = BTreeBucket(
+                [load(e, 0) for e in entries[0::2]], 
+                [load(e, 0) for e in entries[1::2]], oid)
+        self.reg._save.recordLoaded(oid, stg_kind, otype, bucket)
+        return bucket
+
+    @regKind('btreeNode', False)
+    def _loadAs_btreeNode(self, oid, stg_kind, otype, depth):
+        load = self.loadEntry
+        entries = self.stg.getOrdered(oid)
+        # children stay unloaded, held by oid
+        node = BTreeNode(
+                [load(e, 0) for e in entries[1::2]],
+                [e[0] for e in entries[0::2]], oid)
+        self.reg._save.recordLoaded(oid, stg_kind, otype, node)
+        return node
+
     @regKind('external', True)
     def _loadAs_external(self, oid, stg_kind, otype, depth):
         url = self.stg.getExternal(oid)
@@ -336,6 +697,15 @@ class ObjectDeserializer(object):
             reduction['dictitems'] = dictitems
             del dictitems
 
+        if self.swizzleProxies:
+            if isinstance(obj, list):
+                self._noteParent(oid, obj)
+            if isinstance(obj, dict):
+                self._noteParent(oid, obj.itervalues())
+            ns = getattr(obj, '__dict__', None)
+            if type(ns) is dict:
+                self._noteParent(oid, ns.itervalues())
+
         return self.onLoadedObject(oid, obj)
 
     del regKind
@@ -354,7 +724,7 @@ class ObjectDeserializer(object):
         if obj is None:
             return oid
 
-        self.oidToObj.addByLoad(oid, obj, replace)
+        self.oidToObj.addByLoad(oid, obj, replace, otype)
         self.objToOid.addByLoad(oid, obj, replace)
         return oid
 
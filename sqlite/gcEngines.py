@@ -0,0 +1,461 @@
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+##~ Copyright (C) 2002-2007  TechGame Networks, LLC.              ##
+##~                                                               ##
+##~ This library is free software; you can redistribute it        ##
+##~ and/or modify it under the terms of the BSD style License as  ##
+##~ found in the LICENSE file included with this distribution.    ##
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Imports
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import sys
+import time
+import sqlite3
+import threading
+from array import array
+from bisect import bisect_left
+
+from . import sqlScripts as sql
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Definitions
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+gcEngines = {}
+
+def regEngine(name):
+    def registerEngine(klass):
+        gcEngines[name] = klass
+        return klass
+    return registerEngine
+
+class GCEngine(object):
+    """Base for the collectors SQLStorage.gcMode selects between.
+
+    collect() returns (nCollected, nReachable) like SQLStorage.gcReap, and
+    leaves (phase, seconds) pairs in timings."""
+
+    # Garbage oids deleted per statement during the sweep
+    sweepChunkSize = 500
+
+    nCollected = 0
+    count = 0
+
+    def __init__(self, stg):
+        self.stg = stg
+        self.timings = []
+
+    def collect(self):
+        raise NotImplementedError('Subclass Responsibility: %r' % (self,))
+
+    def abandon(self):
+        pass
+
+    def _timed(self, phase, tstart):
+        tnow = time.time()
+        self.timings.append((phase, tnow - tstart))
+        return tnow
+
+    def sweep(self, cur, garbage):
+        """Deletes the rows of the garbage oids, sweepChunkSize at a time"""
+        nCollected = 0
+        chunk = []
+        for oid in garbage:
+            chunk.append(oid)
+            if len(chunk) >= self.sweepChunkSize:
+                nCollected += self.stg.sweepOids(cur, chunk)
+                chunk = []
+        if chunk:
+            nCollected += self.stg.sweepOids(cur, chunk)
+
+        if nCollected:
+            cur.execute('delete from exports where oid_ref not in oids')
+        return nCollected
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Bitmap mark and sweep
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class BitmapMarkSweep(GCEngine):
+    """Marks in memory over the edge list read in one pass of mappings.
+
+    Oids are remapped to dense indexes into a sorted array, and the edges
+    are held as compressed rows: offsets[i]:offsets[i+1] spans the targets
+    of index i.  Memory is about 16 bytes per oid plus 4 per edge, with a
+    single bit per oid for the marks."""
+
+    def collect(self):
+        stg = self.stg
+        r = stg.writeCursor
+        if not r: return
+        stg.db.commit()
+
+        tstart = time.time()
+        oids = self.loadOids(r)
+        offsets, targets = self.loadEdges(r, oids)
+        tstart = self._timed('load', tstart)
+
+        roots = self.loadRoots(r, oids)
+        marks, count = self.mark(roots, offsets, targets)
+        tstart = self._timed('mark', tstart)
+
+        nCollected = 0
+        if count > len(roots):
+            nCollected = self.sweep(r, (oids[i] for i in xrange(len(oids))
+                                    if not marks[i >> 3] & (1 << (i & 7))))
+            if nCollected:
+                stg.db.commit()
+        self._timed('sweep', tstart)
+        return nCollected, count
+
+    def loadOids(self, cur):
+        oids = array('l')
+        oids.extend(e[0] for e in cur.execute(
+            'select oid from oid_lookup_raw order by oid'))
+        return oids
+
+    def loadEdges(self, cur, oids):
+        n = len(oids)
+        offsets = array('i', [0]) * (n+1)
+        targets = array('i')
+        packedTags = sql.packedTags
+
+        # hosts arrive in order, so offsets are filled forward up to each
+        fill = 0
+        host = h = None
+        r = cur.execute(
+            'select oid_host, oid_key, oid_value, v_tag, v_inline '
+            '  from mappings order by oid_host')
+        for oid_host, oid_key, oid_value, tag, blob in r:
+            if oid_host != host:
+                host = oid_host
+                h = bisect_left(oids, host)
+                if h == n or oids[h] != host:
+                    h = None
+                    continue
+                while fill <= h:
+                    offsets[fill] = len(targets)
+                    fill += 1
+            elif h is None:
+                continue
+
+            if tag in packedTags:
+                members = sql.unpackOids(blob)
+            else: members = (oid_key, oid_value)
+            for oid in members:
+                if oid is not None:
+                    t = bisect_left(oids, oid)
+                    if t < n and oids[t] == oid:
+                        targets.append(t)
+
+        while fill <= n:
+            offsets[fill] = len(targets)
+            fill += 1
+        return offsets, targets
+
+    def loadRoots(self, cur, oids):
+        n = len(oids)
+        roots = set()
+        for oid, in cur.execute('select oid_ref from exports'):
+            i = bisect_left(oids, oid)
+            if i < n and oids[i] == oid:
+                roots.add(i)
+        return roots
+
+    def mark(self, roots, offsets, targets):
+        marks = array('B', [0]) * ((len(offsets)+7) >> 3)
+        stack = array('i')
+        for i in roots:
+            marks[i >> 3] |= 1 << (i & 7)
+            stack.append(i)
+
+        count = len(stack)
+        while stack:
+            i = stack.pop()
+            for t in targets[offsets[i]:offsets[i+1]]:
+                bit = 1 << (t & 7)
+                if not marks[t >> 3] & bit:
+                    marks[t >> 3] |= bit
+                    stack.append(t)
+                    count += 1
+        return marks, count
+
+regEngine('bitmap')(BitmapMarkSweep)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Incremental mark and sweep
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class IncrementalMarkSweep(GCEngine):
+    """Marks and sweeps in time-budgeted steps between other work.
+
+    Reached oids are kept in oidGraphMarked, and those whose rows are yet
+    to be scanned in oidGraphGray.  SQLStorage.gcBarrier shades the oids
+    referred to by writes made during the collection, so a container
+    scanned before a write still keeps its new members.  Oids allocated
+    after the collection starts are never swept."""
+
+    # Gray oids scanned per mark statement
+    markChunkSize = 200
+
+    phase = None
+    oidLimit = None
+    sweepFrom = None
+    nRoots = 0
+
+    def collect(self):
+        while self.step(None):
+            pass
+        return self.nCollected, self.count
+
+    def step(self, budget):
+        """Runs mark and sweep slices until budget seconds have elapsed;
+        returns False once the collection is complete"""
+        r = self.stg.writeCursor
+        if not r: 
+            return False
+
+        tstart = time.time()
+        if self.phase is None:
+            self.start(r)
+        deadline = None if budget is None else tstart + budget
+
+        while deadline is None or time.time() < deadline:
+            # gray oids shaded by the barrier are traced before sweeping on
+            if self.markSlice(r):
+                continue
+            self.phase = 'sweep'
+            # like gcReap, nothing is swept when only the roots were reached
+            if self.count <= self.nRoots or not self.sweepSlice(r):
+                self.finish(r)
+                self._timed(self.phase, tstart)
+                return False
+
+        self._timed(self.phase, tstart)
+        return True
+
+    def start(self, cur):
+        stg = self.stg
+        self.phase = 'mark'
+        self.oidLimit = stg.nextOid
+        self.sweepFrom = -1
+        self.nCollected = 0
+        self.count = 0
+
+        cur.execute('delete from oidGraphMarked')
+        cur.execute('delete from oidGraphGray')
+        roots = [oid for oid, in cur.execute('select oid_ref from exports')]
+        self.shade(roots)
+        self.nRoots = self.count
+
+    def shade(self, oids):
+        r = self.stg._cursor
+        oids = list(set(oids))
+        for i in xrange(0, len(oids), self.markChunkSize):
+            chunk = oids[i:i+self.markChunkSize]
+            marked = set(oid for oid, in r.execute(
+                'select oid from oidGraphMarked where oid in (%s)' % (
+                    ','.join('?'*len(chunk)),), chunk))
+            chunk = [(oid,) for oid in chunk if oid not in marked]
+            if chunk:
+                r.executemany('insert into oidGraphMarked values (?)', chunk)
+                r.executemany('insert into oidGraphGray values (?)', chunk)
+                self.count += len(chunk)
+
+    def markSlice(self, cur):
+        gray = [oid for oid, in cur.execute(
+            'select oid from oidGraphGray limit ?', (self.markChunkSize,))]
+        if not gray:
+            return 0
+
+        marks = ','.join('?'*len(gray))
+        packedTags = sql.packedTags
+        targets = set()
+        for oid_key, oid_value, tag, blob in cur.execute(
+                'select oid_key, oid_value, v_tag, v_inline from mappings '
+                '  where oid_host in (%s)' % (marks,), gray):
+            if tag in packedTags:
+                targets.update(sql.unpackOids(blob))
+            else: 
+                targets.add(oid_key)
+                targets.add(oid_value)
+        targets.discard(None)
+
+        cur.execute('delete from oidGraphGray where oid in (%s)' % (marks,), gray)
+        self.shade(targets)
+        return len(gray)
+
+    def sweepSlice(self, cur):
+        garbage = [oid for oid, in cur.execute(
+            'select oid from oid_lookup_raw '
+            '  where oid > ? and oid < ? and oid not in oidGraphMarked '
+            '  order by oid limit ?', 
+            (self.sweepFrom, self.oidLimit, self.sweepChunkSize))]
+        if not garbage:
+            return 0
+
+        self.sweepFrom = garbage[-1]
+        self.nCollected += self.stg.sweepOids(cur, garbage)
+        return len(garbage)
+
+    def finish(self, cur):
+        stg = self.stg
+        if self.nCollected:
+            cur.execute('delete from exports where oid_ref not in oids')
+            stg.db.commit()
+        cur.execute('delete from oidGraphMarked')
+        cur.execute('delete from oidGraphGray')
+        self.phase = 'done'
+
+regEngine('incremental')(IncrementalMarkSweep)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Concurrent mark, chunked sweep
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class ConcurrentMarkSweep(BitmapMarkSweep):
+    """Marks on a second connection against a WAL snapshot taken after a
+    commit, while the storage connection keeps writing.
+
+    Only oids in the snapshot can be garbage, so oids allocated afterward
+    are never swept.  Oids the write barrier shades after the snapshot,
+    and what they still refer to, are rescued from the garbage before each
+    sweep chunk.  Each chunk is committed on its own, keeping the writer's
+    transactions short."""
+
+    phase = None
+    oidLimit = None
+    garbage = None
+    error = None
+    _thread = None
+
+    def collect(self):
+        while self.step(None):
+            pass
+        return self.nCollected, self.count
+
+    def step(self, budget):
+        """Starts the marking thread, waits on it for up to budget seconds,
+        then sweeps for the rest of the budget; returns False once the
+        collection is complete"""
+        stg = self.stg
+        tstart = time.time()
+        if self.phase is None:
+            self.start()
+
+        if self.phase == 'mark':
+            self._thread.join(budget)
+            if self._thread.isAlive():
+                return True
+            self._thread = None
+            if self.error is not None:
+                self.phase = 'done'
+                raise self.error[0], self.error[1], self.error[2]
+            self.phase = 'sweep'
+            self._timed('mark', self.tmark)
+
+        r = stg.writeCursor
+        if not r:
+            return False
+
+        deadline = None if budget is None else tstart + budget
+        while deadline is None or time.time() < deadline:
+            if not self.sweepSlice(r):
+                self.finish(r)
+                self._timed('sweep', tstart)
+                return False
+        self._timed('sweep', tstart)
+        return True
+
+    def start(self):
+        stg = self.stg
+        if not stg.walMode:
+            raise RuntimeError("Concurrent collection requires SQLStorage.walMode")
+
+        # the snapshot read by the marking thread starts from this commit
+        stg.commit()
+        self.phase = 'mark'
+        self.oidLimit = stg.nextOid
+        self.shaded = set()
+        self.tmark = time.time()
+        t = threading.Thread(target=self._t_mark, args=(stg.dbFilename,))
+        t.setDaemon(True)
+        self._thread = t
+        t.start()
+
+    def abandon(self):
+        self.phase = 'done'
+
+    def _t_mark(self, filename):
+        try:
+            db = sqlite3.connect(filename, isolation_level=None)
+            try:
+                cur = db.cursor()
+                cur.execute('begin')
+                oids = self.loadOids(cur)
+                offsets, targets = self.loadEdges(cur, oids)
+                roots = self.loadRoots(cur, oids)
+                cur.execute('commit')
+            finally:
+                db.close()
+
+            if self.phase != 'mark':
+                return
+            marks, count = self.mark(roots, offsets, targets)
+            self.count = count
+            if count > len(roots):
+                oidLimit = self.oidLimit
+                self.garbage = set(oids[i] for i in xrange(len(oids))
+                                    if not marks[i >> 3] & (1 << (i & 7))
+                                        and oids[i] < oidLimit)
+            else: self.garbage = set()
+        except Exception:
+            self.error = sys.exc_info()
+
+    def shade(self, oids):
+        self.shaded.update(oids)
+
+    def rescue(self, cur):
+        """Removes shaded oids, and the garbage they refer to in the current
+        rows, from the garbage still to be swept"""
+        garbage = self.garbage
+        work = [oid for oid in self.shaded if oid in garbage]
+        self.shaded.clear()
+        packedTags = sql.packedTags
+        while work:
+            garbage.difference_update(work)
+            chunk = work[:self.sweepChunkSize]
+            work = work[self.sweepChunkSize:]
+            for oid_key, oid_value, tag, blob in cur.execute(
+                    'select oid_key, oid_value, v_tag, v_inline from mappings '
+                    '  where oid_host in (%s)' % (','.join('?'*len(chunk)),), chunk):
+                if tag in packedTags:
+                    members = sql.unpackOids(blob)
+                else: members = (oid_key, oid_value)
+                for oid in members:
+                    if oid in garbage:
+                        garbage.discard(oid)
+                        work.append(oid)
+
+    def sweepSlice(self, cur):
+        self.rescue(cur)
+        garbage = self.garbage
+        chunk = []
+        while garbage and len(chunk) < self.sweepChunkSize:
+            chunk.append(garbage.pop())
+        if not chunk:
+            return 0
+
+        self.nCollected += self.stg.sweepOids(cur, chunk)
+        self.stg.db.commit()
+        return len(chunk)
+
+    def finish(self, cur):
+        if self.nCollected:
+            cur.execute('delete from exports where oid_ref not in oids')
+            self.stg.db.commit()
+        self.phase = 'done'
+
+regEngine('concurrent')(ConcurrentMarkSweep)
@@ -0,0 +1,107 @@
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+##~ Copyright (C) 2002-2008  TechGame Networks, LLC.              ##
+##~                                                               ##
+##~ This library is free software; you can redistribute it        ##
+##~ and/or modify it under the terms of the BSD style License as  ##
+##~ found in the LICENSE file included with this distribution.    ##
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Definitions
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class LRUMapping(object):
+    """Mapping that keeps its keys in the order they were added, oldest
+    first, for use as an LRU: pop a key and set it again to make it the
+    most recent, and popitem(False) to evict the oldest.  Setting a key
+    already present keeps its place.
+
+    Each entry is a [prev, next, key, value] link of a circular list
+    through a sentinel, so every operation is constant time."""
+
+    def __init__(self):
+        self._links = {}
+        root = self._root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __getitem__(self, key):
+        return self._links[key][3]
+
+    def get(self, key, default=None):
+        link = self._links.get(key)
+        if link is None:
+            return default
+        return link[3]
+
+    def __setitem__(self, key, value):
+        link = self._links.get(key)
+        if link is not None:
+            link[3] = value
+            return
+
+        root = self._root
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = self._links[key] = link
+
+    def __delitem__(self, key):
+        link = self._links.pop(key)
+        self._unlink(link)
+
+    def pop(self, key, *default):
+        link = self._links.pop(key, None)
+        if link is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self._unlink(link)
+        return link[3]
+
+    def popitem(self, last=True):
+        root = self._root
+        if last:
+            link = root[0]
+        else: link = root[1]
+        if link is root:
+            raise KeyError("popitem(): mapping is empty")
+        del self._links[link[2]]
+        self._unlink(link)
+        return link[2], link[3]
+
+    def clear(self):
+        for link in self._links.itervalues():
+            del link[:]
+        self._links.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+    def __iter__(self):
+        root = self._root
+        link = root[1]
+        while link is not root:
+            nextLink = link[1]
+            yield link[2]
+            link = nextLink
+    iterkeys = __iter__
+
+    def itervalues(self):
+        root = self._root
+        link = root[1]
+        while link is not root:
+            nextLink = link[1]
+            yield link[3]
+            link = nextLink
+
+    def keys(self):
+        return list(self)
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
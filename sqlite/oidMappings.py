@@ -10,21 +10,171 @@
 #~ Imports 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+import sys
+import struct
 import weakref
-from .proxy import ObjOidRef, ObjOidProxy
+from itertools import islice
+from .lruMapping import LRUMapping
+from .proxy import ObjOidRef, ObjOidContainerRef, ObjOidProxy, ObjOidContainerProxy
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~ Definitions 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+try:
+    getSizeOf = sys.getsizeof
+except AttributeError:
+    # python 2.5 has no sys.getsizeof; estimate from the type's layout,
+    # counting a pointer per list slot and three per dict or set entry,
+    # and the collector's header on objects it tracks
+    _pointerSize = struct.calcsize('P')
+    _tpflagsHaveGC = 1 << 14
+    def getSizeOf(obj):
+        klass = type(obj)
+        size = klass.__basicsize__
+        if klass.__flags__ & _tpflagsHaveGC:
+            size += 4 * _pointerSize
+        if issubclass(klass, (str, tuple)):
+            size += len(obj) * klass.__itemsize__
+        elif issubclass(klass, unicode):
+            size += len(obj) * 4
+        elif issubclass(klass, list):
+            size += len(obj) * _pointerSize
+        elif issubclass(klass, (dict, set, frozenset)):
+            size += len(obj) * 3 * _pointerSize
+        return size
+
+def approxSizeOf(obj):
+    """Shallow size of obj plus that of its instance __dict__"""
+    size = getSizeOf(obj)
+    if type(obj) not in (ObjOidProxy, ObjOidContainerProxy):
+        d = getattr(obj, '__dict__', None)
+        if type(d) is dict:
+            size += getSizeOf(d)
+    return size
+
+class OidCache(object):
+    """Bounded LRU of strong references to loaded objects, keeping the
+    working set alive for a while after the application lets go of it.
+
+    Bounded by size entries and, if set, maxBytes as measured by
+    approxSizeOf.  policies maps an otype to 'pin', to hold its objects
+    until removed, or to 'skip', to never hold them."""
+
+    hits = misses = evictions = 0
+    def __init__(self, size, maxBytes=None, policies=None):
+        self.size = size
+        self.maxBytes = maxBytes
+        self.policies = dict(policies or ())
+        self.entries = LRUMapping()
+        self.pinned = {}
+        self.nBytes = 0
+
+    def __len__(self):
+        return len(self.entries) + len(self.pinned)
+
+    def add(self, oid, obj, otype=None):
+        policy = self.policies.get(otype)
+        if policy == 'skip':
+            return
+        self.discard(oid)
+        if policy == 'pin':
+            self.pinned[oid] = obj
+            return
+
+        nBytes = approxSizeOf(obj)
+        self.entries[oid] = (obj, nBytes)
+        self.nBytes += nBytes
+        self._trim()
+
+    def hit(self, oid):
+        self.hits += 1
+        entry = self.entries.pop(oid, None)
+        if entry is not None:
+            self.entries[oid] = entry
+
+    def miss(self, oid):
+        self.misses += 1
+
+    def holds(self, oid, obj):
+        """Returns True if obj is the object held for oid"""
+        entry = self.entries.get(oid)
+        if entry is not None:
+            return entry[0] is obj
+        return self.pinned.get(oid) is obj
+
+    def discard(self, oid):
+        self.pinned.pop(oid, None)
+        entry = self.entries.pop(oid, None)
+        if entry is not None:
+            self.nBytes -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.pinned.clear()
+        self.nBytes = 0
+
+    def stats(self):
+        return dict(entries=len(self.entries), pinned=len(self.pinned), 
+                bytes=self.nBytes, hits=self.hits, misses=self.misses, 
+                evictions=self.evictions)
+
+    def _trim(self):
+        entries = self.entries
+        size = self.size; maxBytes = self.maxBytes
+        while entries and ((size and len(entries) > size) 
+                or (maxBytes and self.nBytes > maxBytes)):
+            oid, entry = entries.popitem(False)
+            self.nBytes -= entry[1]
+            self.evictions += 1
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
 class OidMapping(dict):
+    # Loaded objects are held weakly; an OidCache of cacheSize entries or
+    # cacheBytes approximate bytes keeps the most recently used of them
+    # alive besides.  cachePolicies maps otypes to 'pin' or 'skip'.
+    cacheSize = 0
+    cacheBytes = None
+    cachePolicies = {}
+    cache = None
+
+    # Loaded objects that cannot be weakly referenced -- lists, dicts,
+    # tuples, literals -- are held strongly.  Past residentSize of them,
+    # the least recently loaded that nothing else refers to are written
+    # back and dropped, to be loaded afresh when next asked for.  None
+    # for no bound.
+    residentSize = None
+
     def __init__(self):
         self._woids = weakref.WeakValueDictionary()
+        self._resident = LRUMapping()
+        if self.cacheSize or self.cacheBytes:
+            self.cache = OidCache(self.cacheSize, self.cacheBytes, 
+                    self.cachePolicies)
 
     def __missing__(self, oid):
-        return self._woids.get(oid, None)
+        obj = self._woids.get(oid, None)
+        cache = self.cache
+        if cache is not None:
+            if obj is not None:
+                cache.hit(oid)
+            else: cache.miss(oid)
+        return obj
 
-    def addByLoad(self, oid, obj, replace=False):
+    def isLoaded(self, oid):
+        """Probes for oid without counting or reordering cache entries"""
+        return dict.__contains__(self, oid) or oid in self._woids
+
+    def peek(self, oid):
+        """Returns the object loaded for oid, or None, without counting or
+        reordering cache entries"""
+        obj = dict.get(self, oid)
+        if obj is None:
+            obj = self._woids.get(oid)
+        return obj
+
+    def addByLoad(self, oid, obj, replace=False, otype=None):
         #if not replace:
         #    if oid in self:
         #        assert self[oid] is obj, (oid, self[oid], obj)
@@ -36,6 +186,13 @@ class OidMapping(dict):
         except TypeError:
             self[oid] = obj
             self._woids.pop(oid, None)
+            if not isinstance(oid, basestring):
+                self._resident.pop(oid, None)
+                self._resident[oid] = True
+        else:
+            cache = self.cache
+            if cache is not None and not isinstance(oid, basestring):
+                cache.add(oid, obj, otype)
 
     def addByStore(self, oid, obj, replace=False):
         #if not replace:
@@ -46,11 +203,101 @@ class OidMapping(dict):
 
         self[oid] = obj
         self._woids.pop(oid, None)
+        self._resident.pop(oid, None)
+
+    def remove(self, oid, obj=None):
+        self.pop(oid, None)
+        self._woids.pop(oid, None)
+        self._resident.pop(oid, None)
+        if self.cache is not None:
+            self.cache.discard(oid)
+
+    def discardURLPaths(self):
+        """Drops the entries loaded by urlpath, leaving those by oid"""
+        for urlpath, obj in self.urlPathItems():
+            self.remove(urlpath)
+
+    def urlPathItems(self):
+        """Returns (urlpath, obj) for each object loaded by urlpath"""
+        items = [(k, v) for k, v in self.iteritems() if isinstance(k, basestring)]
+        items.extend((k, v) for k, v in self._woids.items() if isinstance(k, basestring))
+        return items
 
     def clear(self):
         self._woids.clear()
+        self._resident.clear()
+        if self.cache is not None:
+            self.cache.clear()
         return dict.clear(self)
 
+    def cacheStats(self):
+        if self.cache is not None:
+            return self.cache.stats()
+
+    def releaseCommitted(self, objToOid):
+        """Once their state is committed, holds weakly the objects that
+        allow it, and makes the others resident"""
+        woids = self._woids
+        resident = self._resident
+        for oid, obj in self.items():
+            if isinstance(oid, basestring):
+                continue
+            try:
+                woids[oid] = obj
+            except TypeError:
+                if oid not in resident:
+                    resident[oid] = True
+            else:
+                dict.__delitem__(self, oid)
+                objToOid.weaken(obj)
+        objToOid.releasePinned()
+
+    def trimResidency(self, objToOid, save):
+        """Drops the surplus of resident objects over residentSize, oldest
+        first, skipping those still referred to from outside the maps"""
+        size = self.residentSize
+        resident = self._resident
+        if size is None or len(resident) <= size:
+            return 0
+
+        nDropped = 0
+        for oid in list(islice(resident, len(resident)-size)):
+            obj = dict.get(self, oid)
+            if obj is None:
+                del resident[oid]
+                continue
+
+            # references: this map, obj, the argument, and the pin in
+            # objToOid when it holds one
+            if sys.getrefcount(obj) > 3 + objToOid.isRetained(obj):
+                # still in use; counts as recently used
+                del resident[oid]
+                resident[oid] = True
+                continue
+
+            save.storeOpen(obj)
+            self.remove(oid)
+            objToOid.remove(obj)
+            nDropped += 1
+        return nDropped
+
+    def memoryReport(self):
+        """Returns {otype: (count, approximate bytes)} for the objects held
+        strongly and, separately, those held weakly"""
+        def report(objs):
+            r = {}
+            for obj in objs:
+                klass = type(obj)
+                otype = klass.__name__
+                if klass.__module__ != '__builtin__':
+                    otype = klass.__module__+'.'+otype
+                count, size = r.get(otype, (0, 0))
+                r[otype] = (count+1, size+approxSizeOf(obj))
+            return r
+        strong = [v for k, v in self.iteritems() if not isinstance(k, basestring)]
+        weak = [v for k, v in self._woids.items() if not isinstance(k, basestring)]
+        return dict(strong=report(strong), weak=report(weak))
+
     def commitOpen(self, save):
         for oid, v in self.items():
             newOid = save.storeOpen(v)
@@ -65,9 +312,59 @@ class OidMapping(dict):
             newOid = save.storeOpen(v)
             #assert newOid == oid, (oid, newOid, type(v))
 
+    def commitDirty(self, save, dirtyOids):
+        while dirtyOids:
+            oid = dirtyOids.pop()
+            v = self[oid]
+            if v is None or isinstance(v, ObjOidProxy):
+                # collected, or never faulted in -- nothing to write
+                continue
+            save.storeOpen(v)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class OidDigestMap(dict):
+    """Maps oid to the (otype, digest) last loaded from or written to the
+    database, so that unchanged objects can be skipped on commit."""
+
+    nWritten = 0
+    nSkipped = 0
+
+    def isCurrent(self, oid, otype, digest=None):
+        entry = self.get(oid)
+        if entry is None or entry[0] != otype:
+            return False
+        return digest is None or entry[1] == digest
+
+    def record(self, oid, otype, digest):
+        self[oid] = (otype, digest)
+
+    def invalidate(self, oids=None):
+        if oids is None:
+            self.clear()
+        else:
+            pop = self.pop
+            for oid in oids:
+                pop(oid, None)
+
+    def resetStats(self):
+        self.nWritten = 0
+        self.nSkipped = 0
+
+    def stats(self):
+        return dict(written=self.nWritten, skipped=self.nSkipped)
+
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 class ObjMapping(dict):
+    # Loaded objects are pinned here so their ids stay unique while they
+    # are mapped.  Pins of objects that can be weakly referenced are
+    # weakened once their state is in the database: after a commit, or
+    # right after loading for objects not marked dirty when only dirty
+    # objects are committed.
+    def __init__(self):
+        self._pinned = set()
+
     def find(self, obj):
         key = self.keyForObj(obj)
         return self.get(key)
@@ -82,6 +379,50 @@ class ObjMapping(dict):
         self[key] = oid
         ##assert self.find(obj) == oid
 
+    def remove(self, obj):
+        key = self.keyForObj(obj)
+        self.pop(key, None)
+        self.pop((None, key), None)
+        self._pinned.discard(key)
+
+    def isRetained(self, obj):
+        """True if obj is pinned strongly by this map"""
+        return self.get((None, id(obj))) is obj
+
+    def releasePinned(self, keepOids=()):
+        """Weakens the pins taken since the last release where the objects
+        allow it, except for those of keepOids; the entries for an object
+        go once it is collected"""
+        pinned = self._pinned
+        self._pinned = set()
+        for key in pinned:
+            obj = self.get((None, key))
+            if obj is None or type(obj) is weakref.ref:
+                continue
+            if keepOids and self.get(key) in keepOids:
+                self._pinned.add(key)
+                continue
+            self.weaken(obj)
+
+    def weaken(self, obj):
+        """Holds obj weakly, dropping its entries once it is collected"""
+        key = id(obj)
+        if key not in self:
+            return
+        try:
+            self[None, key] = weakref.ref(obj, self._unpinFn(key))
+        except TypeError:
+            pass
+
+    def _unpinFn(self, key):
+        wrself = weakref.ref(self)
+        def unpin(wr):
+            self = wrself()
+            if self is not None and self.get((None, key)) is wr:
+                self.pop((None, key), None)
+                self.pop(key, None)
+        return unpin
+
     def addByLoad(self, oid, obj, replace=False):
         key = self.keyForObj(obj, True)
         if not replace and key in self:
@@ -105,7 +446,7 @@ class ObjMapping(dict):
             key = None
             return key
 
-        elif otype in (ObjOidProxy, ObjOidRef):
+        elif otype in (ObjOidProxy, ObjOidContainerProxy, ObjOidRef, ObjOidContainerRef):
             key = ('oid', obj.__getProxy__().oid)
             return key
 
@@ -113,6 +454,7 @@ class ObjMapping(dict):
             key = id(obj)
             if retain:
                 self[None, key] = obj
+                self._pinned.add(key)
 
         #if key in self:
         #    oid = self[key]
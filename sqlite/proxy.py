@@ -18,16 +18,28 @@ from TG.objdbs.objProxy import ProxyComplete
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 class ObjOidRef(object):
-    host = None
-    oid = None
-    ref = None
-    otype = None
+    # One ref exists per unloaded object, so it is kept small: otype is
+    # held as the storage's small integer id for it, interned by the host.
+    # parents holds the oids of the loaded containers and objects holding
+    # the proxy, when the host swizzles them on fault.
+    __slots__ = ('host', 'oid', 'ref', 'wrproxy', '_otype', 'parents', '__weakref__')
+
     def __init__(self, host, oid, otype=None):
         self.host = host
         self.oid = oid
+        self.ref = None
         self.wrproxy = None
-        #if otype is not None:
-        #    self.otype = otype
+        self.parents = None
+        if otype is not None:
+            otype = host.otypeId(otype)
+        self._otype = otype
+
+    def getOType(self):
+        otype = self._otype
+        if otype is not None:
+            otype = self.host.otypeForId(otype)
+        return otype
+    otype = property(getOType)
 
     def __repr__(self):
         if self.otype is None:
@@ -38,23 +50,36 @@ class ObjOidRef(object):
     def __getProxy__(self): 
         return self
 
-    def proxy(self):
-        pxy = self.wrproxy
-        if pxy is not None:
-            obj = pxy()
-            if obj is not None:
-                return obj
+    def proxy(self, strong=False):
+        """Returns the proxy for this ref, creating it if needed.  With
+        strong, a new proxy is held directly rather than by a weakref; the
+        pair is then freed by the cycle collector."""
+        obj = self.liveProxy()
+        if obj is not None:
+            return obj
 
-        obj = ObjOidProxy(self)
-        self.wrproxy = weakref.ref(obj)
+        obj = self.proxyClass(self)
+        if strong:
+            self.wrproxy = obj
+        else: self.wrproxy = weakref.ref(obj)
         return obj
 
+    def liveProxy(self):
+        """Returns the proxy for this ref if one exists, or None"""
+        pxy = self.wrproxy
+        if type(pxy) is weakref.ref:
+            pxy = pxy()
+        return pxy
+
     def load(self, autoload=True):
         ref = self.ref
         if ref is None and autoload:
             ref = self.host.loadOidRef(self)
         return ref
 
+    def markDirty(self):
+        self.host.markDirtyOid(self.oid)
+
     def __getstate__(self):
         raise NotImplementedError("__getstate__ on ObjOidRef should never be called")
 
@@ -90,3 +115,161 @@ class ObjOidProxy(ProxyComplete):
         obj = self.__proxy__()
         return getattr(obj, name)
 
+    #~ write barrier ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    # Mutations that pass through the proxy mark the oid dirty so that a
+    # dirty-only commit knows to write it.  The list/dict/set mutator
+    # methods are ProxyMutatorMethod class attributes, set below.
+
+    _mutatingMethods = frozenset([
+        'append', 'extend', 'insert', 'pop', 'remove', 'sort', 'reverse',
+        'add', 'discard', 'update', 'setdefault', 'popitem', 'clear',
+        'difference_update', 'intersection_update', 'symmetric_difference_update',
+        ])
+
+    def __setattr__(self, name, value):
+        ProxyComplete.__setattr__(self, name, value)
+        self.__getProxy__().markDirty()
+    def __delattr__(self, name):
+        ProxyComplete.__delattr__(self, name)
+        self.__getProxy__().markDirty()
+
+    def __setitem__(self, key, value):
+        ProxyComplete.__setitem__(self, key, value)
+        self.__getProxy__().markDirty()
+    def __delitem__(self, key):
+        ProxyComplete.__delitem__(self, key)
+        self.__getProxy__().markDirty()
+
+    def __setslice__(self, i, j, sequence):
+        ProxyComplete.__setslice__(self, i, j, sequence)
+        self.__getProxy__().markDirty()
+    def __delslice__(self, i, j):
+        ProxyComplete.__delslice__(self, i, j)
+        self.__getProxy__().markDirty()
+
+    def __iadd__(self, other):
+        self.__getProxy__().markDirty()
+        return ProxyComplete.__iadd__(self, other)
+    def __imul__(self, other):
+        self.__getProxy__().markDirty()
+        return ProxyComplete.__imul__(self, other)
+
+class ProxyMutatorMethod(object):
+    """Looks up a mutator method of a proxied list, dict or set, wrapped to
+    mark the oid dirty when it is called rather than when it is looked up.
+    Attributes of the same name on other objects are returned as is."""
+
+    containerTypes = (list, dict, set)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, pxy, klass=None):
+        if pxy is None:
+            return self
+
+        obj = pxy.__proxy__()
+        method = getattr(obj, self.name)
+        if not isinstance(obj, self.containerTypes) or not callable(method):
+            return method
+
+        oidRef = pxy.__getProxy__()
+        def markDirtyOnCall(*args, **kw):
+            oidRef.markDirty()
+            return method(*args, **kw)
+        return markDirtyOnCall
+
+for name in ObjOidProxy._mutatingMethods:
+    setattr(ObjOidProxy, name, ProxyMutatorMethod(name))
+del name
+
+ObjOidRef.proxyClass = ObjOidProxy
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class ObjOidContainerProxy(ObjOidProxy):
+    """Proxy for a stored list, set or dict.  Until the container is
+    faulted in, len, in, indexing and iteration are answered by the host
+    with queries against the container's rows instead of a full load."""
+
+    def __len__(self):
+        obj = self.__proxyOrNone__()
+        if obj is not None:
+            return len(obj)
+
+        objRef = self.__getProxy__()
+        return objRef.host.containerLen(objRef)
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def __contains__(self, item):
+        obj = self.__proxyOrNone__()
+        if obj is None:
+            objRef = self.__getProxy__()
+            if objRef.otype == 'dict':
+                r = objRef.host.containerLookup(objRef, item)
+                if r is not None:
+                    return r[0]
+            else:
+                r = objRef.host.containerContains(objRef, item)
+                if r is not None:
+                    return r
+            obj = self.__proxy__()
+        return item in obj
+
+    def __getitem__(self, key):
+        obj = self.__proxyOrNone__()
+        if obj is None:
+            objRef = self.__getProxy__()
+            if objRef.otype == 'dict':
+                r = objRef.host.containerLookup(objRef, key)
+                if r is not None:
+                    if not r[0]:
+                        raise KeyError(key)
+                    return r[1]
+
+            elif objRef.otype == 'list':
+                if isinstance(key, slice):
+                    start, stop, step = key.indices(len(self))
+                    if step == 1:
+                        return objRef.host.containerPage(objRef, start, max(0, stop-start))
+
+                elif isinstance(key, (int, long)):
+                    n = len(self)
+                    index = key
+                    if index < 0:
+                        index += n
+                    if not 0 <= index < n:
+                        raise IndexError("list index out of range")
+                    return objRef.host.containerPage(objRef, index, 1)[0]
+
+            obj = self.__proxy__()
+        return obj[key]
+
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(i, j))
+
+    def __iter__(self):
+        obj = self.__proxyOrNone__()
+        if obj is not None:
+            return iter(obj)
+        return self.__iterPages__()
+
+    def __iterPages__(self):
+        objRef = self.__getProxy__()
+        host = objRef.host
+        pageSize = host.containerPageSize
+
+        offset = 0
+        while 1:
+            page = host.containerPage(objRef, offset, pageSize)
+            for item in page:
+                yield item
+            if len(page) < pageSize:
+                break
+            offset += len(page)
+
+class ObjOidContainerRef(ObjOidRef):
+    __slots__ = ()
+    proxyClass = ObjOidContainerProxy
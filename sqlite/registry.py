@@ -11,9 +11,12 @@
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 import gc
+import sys
+import Queue
+from threading import Lock, Timer
 
-from .oidMappings import OidMapping, ObjMapping
-from .commands import ThreadedCommands
+from .oidMappings import OidMapping, ObjMapping, OidDigestMap
+from .commands import CommandFuture, ThreadedCommands
 from .serialize import ObjectSerializer
 from .deserialize import ObjectDeserializer
 from .sqlStorage import SQLStorage
@@ -23,7 +26,24 @@ from .sqlStorage import SQLStorage
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 class SQLObjectRegistryBase(object):
+    # storeAsync queues at most storeQueueSize stores, blocking its caller
+    # while the queue is full.  commitAsync requests made within
+    # groupCommitWindow seconds of each other share one transaction.
+    storeQueueSize = 10000
+    groupCommitWindow = 0.01
+
+    # Approximate bytes the targets of faulted proxies may hold before the
+    # least recently faulted clean ones are unloaded, to be faulted in
+    # again on next use.  None for no budget.
+    memoryBudget = None
+
     def __init__(self, filename, dbid=None):
+        self._storeQueue = Queue.Queue(self.storeQueueSize)
+        self._storeLock = Lock()
+        self._storeDrainQueued = False
+        self._storeErrors = []
+        self._commitWaiters = []
+
         self._tinit()
         self._tcall(self._initFileStorage, filename, dbid)
 
@@ -53,6 +73,16 @@ class SQLObjectRegistryBase(object):
 
     def commit(self): 
         return self._tcall(self._save.commit)
+    def commitStats(self):
+        return self._save.lastCommitStats
+    def cacheStats(self):
+        return self._tcall(self.stg.oidToObj.cacheStats)
+    def memoryReport(self):
+        return self._tcall(self.stg.oidToObj.memoryReport)
+    def residentBytes(self):
+        return self._tcall(self._load.residentBytes)
+    def pageOut(self, budget=None):
+        return self._tcall(self._load.pageOut, budget)
 
     def gc(self): 
         return self._tcall(self.stg.gc)
@@ -79,6 +109,14 @@ class SQLObjectRegistryBase(object):
         return self.remove(obj)
 
     def load(self, oid, default=None, depth=1):
+        pool = self.stg.readPool
+        if pool is not None and oid and not self.stg.oidToObj.isLoaded(oid):
+            # rows are fetched on a pooled connection in this thread; only
+            # staging them and building objects is left to the command thread
+            staged = pool.prefetch(oid, 
+                    self._load.prefetchLevels(depth), self.stg.prefetchLimit)
+            if staged is not None:
+                return self._tcall(self._loadStaged, staged, oid, default, depth)
         return self._tcall(self._load.loadOid, oid, default, depth)
     def store(self, obj, urlpath=None):
         return self._tcall(self._save.store, obj, urlpath)
@@ -86,10 +124,116 @@ class SQLObjectRegistryBase(object):
         return self._tcall(self._save.storeAll, iter, named)
     def remove(self, obj):
         return self._tcall(self._save.remove, obj)
+    def markDirty(self, obj):
+        """Flags obj for the next commit; needed for mutations that bypass the proxy"""
+        return self._tcall(self._save.markDirty, obj)
 
     def close(self):
         return self._tclose()
 
+    def submit(self, fn, *args, **kw):
+        """Runs fn on the command thread without waiting for it, returning
+        a CommandFuture; e.g. submit(reg.load, 'root').result()"""
+        return self._tsubmit(fn, *args, **kw)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Store pipeline
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def storeAsync(self, obj, urlpath=None):
+        """Queues obj to be stored by the command thread without waiting
+        for it; stores of the same obj queued together are done once"""
+        self._storeQueue.put((obj, urlpath))
+        self._storeLock.acquire()
+        try:
+            queued = self._storeDrainQueued
+            self._storeDrainQueued = True
+        finally:
+            self._storeLock.release()
+        if not queued:
+            self._tsend(self._drainStores)
+
+    def commitAsync(self, callback=None):
+        """Requests a commit of everything stored so far, returning a
+        CommandFuture done once it is durable.  callback(future) is called
+        on the command thread at that point."""
+        future = CommandFuture()
+        if callback is not None:
+            future.addDoneCallback(callback)
+
+        self._storeLock.acquire()
+        try:
+            waiters = self._commitWaiters
+            waiters.append(future)
+            first = len(waiters) == 1
+        finally:
+            self._storeLock.release()
+
+        if first:
+            window = self.groupCommitWindow
+            if window:
+                timer = Timer(window, self._tsend, (self._groupCommit,))
+                timer.setDaemon(True)
+                timer.start()
+            else: self._tsend(self._groupCommit)
+        return future
+
+    def _drainStores(self):
+        self._storeLock.acquire()
+        try:
+            self._storeDrainQueued = False
+        finally:
+            self._storeLock.release()
+
+        qStore = self._storeQueue
+        batch = []; seen = set()
+        while 1:
+            try:
+                obj, urlpath = qStore.get_nowait()
+            except Queue.Empty:
+                break
+            key = (id(obj), urlpath)
+            if key not in seen:
+                seen.add(key)
+                batch.append((obj, urlpath))
+
+        store = self._save.store
+        for obj, urlpath in batch:
+            try:
+                store(obj, urlpath)
+            except Exception:
+                excInfo = sys.exc_info()
+                sys.excepthook(*excInfo)
+                self._storeErrors.append(excInfo)
+        return len(batch)
+
+    def _groupCommit(self):
+        self._storeLock.acquire()
+        try:
+            waiters = self._commitWaiters
+            self._commitWaiters = []
+        finally:
+            self._storeLock.release()
+        if not waiters:
+            return
+
+        self._drainStores()
+        try:
+            result = self._save.commit()
+        except Exception:
+            excInfo = sys.exc_info()
+        else:
+            # a failed store is reported by the commit that would have
+            # made it durable
+            errors = self._storeErrors
+            excInfo = errors[0] if errors else None
+        del self._storeErrors[:]
+
+        for future in waiters:
+            if excInfo is not None:
+                future.setException(excInfo)
+            else: future.setResult(result)
+
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     #~ Mediator Implementation
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -107,16 +251,24 @@ class SQLObjectRegistryBase(object):
         stg.objToOid = ObjMapping()
         stg.oidToObj = OidMapping()
         stg.objToOid.oidToObj = stg.oidToObj
+        stg.oidDigests = OidDigestMap()
+        stg.dirtyOids = set()
 
         self._save = self.ObjectSerializer(self)
         self._load = self.ObjectDeserializer(self)
 
+    def _loadStaged(self, staged, oid, default, depth):
+        self.stg.stageRows(staged)
+        return self._load.loadOid(oid, default, depth)
+
     def _close(self):
+        self._groupCommit()
         self._load.close()
         self._save.close()
 
         self.stg.oidToObj.clear()
         self.stg.objToOid.clear()
+        self.stg.oidDigests.clear()
 
         del self._load
         del self._save
@@ -126,8 +278,10 @@ class SQLObjectRegistryBase(object):
         del self.stg
 
     def _idle(self):
-        ##self.stg.gc()
-        pass
+        stg = self.stg
+        if stg is None:
+            return False
+        return stg.gcIdle()
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     #~ Thread Management
@@ -137,6 +291,8 @@ class SQLObjectRegistryBase(object):
         raise NotImplementedError('Subclass Responsibility: %r' % (self,))
     def _tcall(self, fn, *args, **kw):
         raise NotImplementedError('Subclass Responsibility: %r' % (self,))
+    def _tsubmit(self, fn, *args, **kw):
+        raise NotImplementedError('Subclass Responsibility: %r' % (self,))
     def _tsend(self, fn, *args, **kw):
         raise NotImplementedError('Subclass Responsibility: %r' % (self,))
     def _tclose(self):
@@ -164,6 +320,9 @@ class SQLObjectRegistry(SQLObjectRegistryBase):
     def _tcall(self, fn, *args, **kw):
         return self._tcmds.call(fn, *args, **kw)
 
+    def _tsubmit(self, fn, *args, **kw):
+        return self._tcmds.submit(fn, *args, **kw)
+
     def _tclose(self):
         tcmds = self._tcmds
         tcmds.close()
@@ -12,9 +12,12 @@
 
 import weakref
 import pickle 
+import marshal
+import hashlib
 from copy_reg import __newobj__
 
-from .proxy import ObjOidRef, ObjOidProxy
+from .proxy import ObjOidRef, ObjOidContainerRef, ObjOidProxy, ObjOidContainerProxy
+from .btree import PersistentBTree, BTreeBucket, BTreeNode
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~ Definitions 
@@ -28,6 +31,18 @@ class reduction_dict(list):
 
 class ObjectSerializer(object):
     _reduceProtocol = 2
+    lastCommitStats = None
+
+    # When True, commit() only writes objects that were stored or marked
+    # dirty since the last commit -- either through the ObjOidProxy write
+    # barrier or an explicit markDirty() -- instead of every open object.
+    commitDirtyOnly = False
+
+    # Scalars referenced from containers are written into the container's
+    # mappings rows rather than given an oid of their own; strings longer
+    # than inlineMaxLen still go through the literals table.
+    inlineLiterals = True
+    inlineMaxLen = 64
 
     def __init__(self, reg):
         self._keepitclose = []
@@ -37,6 +52,8 @@ class ObjectSerializer(object):
         self.stg = stg
         self.objToOid = stg.objToOid
         self.oidToObj = stg.oidToObj
+        self.oidDigests = stg.oidDigests
+        self.dirtyOids = stg.dirtyOids
 
     def __repr__(self):
         return self.stg.dbid
@@ -55,6 +72,30 @@ class ObjectSerializer(object):
             oid = self._storeObject(obj)
         return oid
 
+    _inlineTypes = {bool: 'bool', int: 'int', float: 'float', str: 'str', unicode: 'unicode'}
+    def inlineRef(self, value):
+        """Returns a (value_type, value) reference for scalars small enough
+        to be held inline in a container row, otherwise None"""
+        tag = self._inlineTypes.get(type(value))
+        if tag is None or not self.inlineLiterals:
+            return None
+        if tag == 'float':
+            if value != value: 
+                return None
+        elif tag in ('str', 'unicode'):
+            if len(value) > self.inlineMaxLen:
+                return None
+        return (tag, value)
+
+    def refForObj(self, obj, create=True):
+        """Container reference for obj: an inline literal or an oid"""
+        ref = self.inlineRef(obj)
+        if ref is None:
+            if create:
+                ref = self.oidForObj(obj)
+            else: ref = self._findOid(obj)
+        return ref
+
     def setOidForObj(self, obj, otype, oid, replace=False):
         self.oidToObj.addByStore(oid, obj, replace)
         self.objToOid.addByStore(oid, obj, replace)
@@ -84,6 +125,15 @@ class ObjectSerializer(object):
             self.stg.setURLPathForOid(urlPath, oid)
 
         self.clearDeferred()
+        self.dirtyOids.add(oid)
+        return oid
+
+    def markDirty(self, obj):
+        oid = self.oidForObj(obj, False)
+        if oid is not None:
+            self.dirtyOids.add(oid)
+            # hold obj until it is written
+            self.objToOid.keyForObj(obj, True)
         return oid
 
     def storeOpen(self, obj, urlPath=None):
@@ -104,6 +154,42 @@ class ObjectSerializer(object):
         self.stg.removeOid(oid)
         return oid
 
+    def recordLoaded(self, oid, stg_kind, otype, obj):
+        """Records the digest of a freshly loaded object so that an
+        unmodified object is not rewritten on the next commit"""
+        digestFn = self._digestByKindMap.get(stg_kind)
+        if digestFn is None:
+            return None
+
+        digest = digestFn(self, obj, False)
+        if digest is not None:
+            self.oidDigests.record(oid, otype, digest)
+        return digest
+
+    def isUnchanged(self, oid, stg_kind, otype, obj):
+        """True if obj is known to still match the digest recorded when
+        it was loaded or last written"""
+        if oid in self.dirtyOids:
+            return False
+
+        digestFn = self._digestByKindMap.get(stg_kind)
+        if digestFn is None:
+            return False
+        digest = digestFn(self, obj, False)
+        if digest is None:
+            return False
+        return self.oidDigests.isCurrent(oid, otype, digest)
+
+    def _setIfChanged(self, oid, otype, digest):
+        digests = self.oidDigests
+        if digests.isCurrent(oid, otype, digest):
+            digests.nSkipped += 1
+            return False
+
+        digests.record(oid, otype, digest)
+        digests.nWritten += 1
+        return True
+
     def _storeObject(self, obj):
         oid = self.storeExternal(obj)
         if oid is not None:
@@ -125,9 +211,17 @@ class ObjectSerializer(object):
         if not self.stg.writable:
             return False
 
+        digests = self.oidDigests
+        digests.resetStats()
         self.storeDeferred()
-        self.oidToObj.commitOpen(self)
+        if self.commitDirtyOnly:
+            self.oidToObj.commitDirty(self, self.dirtyOids)
+        else:
+            self.oidToObj.commitOpen(self)
+            self.dirtyOids.clear()
         self.stg.commit()
+        self.oidToObj.releaseCommitted(self.objToOid)
+        self.lastCommitStats = digests.stats()
         return True
 
     def clearDeferred(self):
@@ -222,15 +316,98 @@ class ObjectSerializer(object):
     @regType([list, set, frozenset])
     def _storeAs_ordered(self, obj):
         oid = self._stg_oid(obj, 'list')
-        self._defer(self._stg_setOrdered, oid, obj)
+        self._defer(self._storeAs_orderedItems, oid, obj)
+        return oid
+
+    def _storeAs_orderedItems(self, oid, obj):
+        valueOids = self._oidsOfOrdered(obj)
+        digest = self._digestOf(valueOids, type(obj) is not list)
+        if self._setIfChanged(oid, self.otypeForObj(obj), digest):
+            self.stg.setOrdered(oid, valueOids)
         return oid
 
     @regType([dict])
     def _storeAs_mapping(self, obj):
         oid = self._stg_oid(obj, 'map')
-        self._defer(self._stg_setMapping, oid, obj.iteritems())
+        self._defer(self._storeAs_mappingItems, oid, obj)
+        return oid
+
+    def _storeAs_mappingItems(self, oid, obj):
+        itemOids = self._oidsOfMapping(obj.iteritems())
+        digest = self._digestOf(itemOids, True)
+        if self._setIfChanged(oid, self.otypeForObj(obj), digest):
+            self.stg.setMapping(oid, itemOids)
+        return oid
+
+    @regType([PersistentBTree])
+    def _storeAs_btree(self, tree):
+        oid = self._stg_oid(tree, 'btree')
+        tree._oid = oid
+        tree._dirtyOids = self.dirtyOids
+        self._defer(self._storeAs_btreeHeader, oid, tree)
+        return oid
+
+    def _storeAs_btreeHeader(self, oid, tree):
+        otype = self.otypeForObj(tree)
+        if not tree._dirty and self.oidDigests.isCurrent(oid, otype):
+            self.oidDigests.nSkipped += 1
+            return oid
+
+        itemOids = self._refsOfBTree(tree)
+        if self._setIfChanged(oid, otype, self._digestOf(itemOids, True)):
+            self.stg.setMapping(oid, itemOids)
+        tree._dirty = False
+        return oid
+
+    @regType([BTreeBucket, BTreeNode])
+    def _storeAs_btreeBucket(self, bucket):
+        oid = self._stg_oid(bucket, bucket.stgKind)
+        bucket._oid = oid
+        self._defer(self._storeAs_btreeBucketItems, oid, bucket)
+        return oid
+
+    def _storeAs_btreeBucketItems(self, oid, bucket):
+        # buckets unchanged since loaded or written are skipped unread
+        otype = self.otypeForObj(bucket)
+        if not bucket._dirty and self.oidDigests.isCurrent(oid, otype):
+            self.oidDigests.nSkipped += 1
+            return oid
+
+        valueOids = self._refsOfBucket(bucket)
+        if self._setIfChanged(oid, otype, self._digestOf(valueOids)):
+            self.stg.setOrdered(oid, valueOids)
+        bucket._dirty = False
         return oid
 
+    def _refsOfBTree(self, tree, create=True):
+        refOf = self.refForObj
+        return [(refOf('root'), self._refOfBucket(tree._root, create)),
+                (refOf('size'), refOf(tree._size))]
+
+    def _refsOfBucket(self, bucket, create=True):
+        # leaves as [key, value, ...]; nodes as [child, key, child, ...]
+        refOf = self.refForObj
+        if type(bucket) is BTreeNode:
+            children = bucket.children
+            refs = [self._refOfBucket(children[0], create)]
+            for key, child in zip(bucket.keys, children[1:]):
+                refs.append(refOf(key, create))
+                refs.append(self._refOfBucket(child, create))
+        else:
+            refs = []
+            for key, value in zip(bucket.keys, bucket.values):
+                refs.append(refOf(key, create))
+                refs.append(refOf(value, create))
+        return refs
+
+    def _refOfBucket(self, bucket, create=True):
+        # buckets not loaded are held by their oid
+        if type(bucket) in (int, long):
+            return bucket
+        if create:
+            return self.oidForObj(bucket)
+        return self._findOid(bucket)
+
     @regType([weakref.ref])
     def _storeAs_weakref(self, obj):
         oid = self._stg_oid(obj, 'weakref')
@@ -238,7 +415,7 @@ class ObjectSerializer(object):
         self.stg.setWeakref(oid, oid_ref)
         return oid
 
-    @regType([ObjOidProxy, ObjOidRef])
+    @regType([ObjOidProxy, ObjOidContainerProxy, ObjOidRef, ObjOidContainerRef])
     def _storeAs_oidRef(self, obj):
         return obj.__getProxy__().oid
 
@@ -257,7 +434,9 @@ class ObjectSerializer(object):
 
     def _storeAs_reduction(self, oid, obj):
         reduction = self._asReductionMap(*self._reduceObj(obj))
-        self._stg_setMapping(oid, reduction)
+        digest = self._digestOfReduction(reduction)
+        if self._setIfChanged(oid, self.otypeForObj(obj), digest):
+            self._stg_setMapping(oid, reduction)
         return oid
 
     def _reduceObj(self, obj):
@@ -320,20 +499,28 @@ class ObjectSerializer(object):
         if otype is None:
             otype = self.otypeForObj(obj)
         oid = self.oidForObj(obj, False)
-        oid = self.stg.setOid(oid, stg_kind, otype)
         if transient:
-            return oid
+            return self.stg.setOid(oid, stg_kind, otype)
+
+        if oid is None or not self.oidDigests.isCurrent(oid, otype):
+            oid = self.stg.setOid(oid, stg_kind, otype)
         return self.setOidForObj(obj, otype, oid)
 
+    def _oidsOfOrdered(self, listitems, create=True):
+        refOf = self.refForObj
+        return [refOf(v, create) for v in listitems]
+
+    def _oidsOfMapping(self, dictitems, create=True):
+        refOf = self.refForObj
+        return [(refOf(k, create), refOf(v, create)) for k, v in dictitems]
+
     def _stg_setOrdered(self, oid, listitems):
-        oidOf = self.oidForObj
-        valueOids = [oidOf(v) for v in listitems]
+        valueOids = self._oidsOfOrdered(listitems)
         self.stg.setOrdered(oid, valueOids)
         return valueOids
 
     def _stg_setMapping(self, oid, dictitems):
-        oidOf = self.oidForObj
-        itemOids = [(oidOf(k), oidOf(v)) for k, v in dictitems]
+        itemOids = self._oidsOfMapping(dictitems)
         self.stg.setMapping(oid, itemOids)
         return itemOids
 
@@ -344,9 +531,88 @@ class ObjectSerializer(object):
 
         if value_type is None:
             value_type = type(value).__name__
-        oid = self.stg.setLiteral(value, hash(value), value_type, stg_kind)
+        stg = self.stg
+        value_hash = stg.hashLiteral(value, value_type)
+        oid = stg.setLiteral(value, value_hash, value_type, stg_kind)
         return self.setOidForObj(value, value_type, oid)
 
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Change detection
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def _findOid(self, obj):
+        if obj is None:
+            return 0
+        return self.objToOid.find(obj)
+
+    def _digestOf(self, oids, unordered=False):
+        if unordered:
+            oids = sorted(oids)
+        return hashlib.md5(marshal.dumps(oids)).digest()
+
+    def _digestOfReduction(self, reduction, create=True):
+        key = []
+        for k, v in reduction:
+            tv = type(v)
+            if tv is reduction_list:
+                v = self._oidsOfOrdered(v, create)
+            elif tv is reduction_dict:
+                v = sorted(self._oidsOfMapping(v, create))
+            else:
+                v = self.refForObj(v, create)
+            key.append((k, v))
+
+        if not create and self._hasUnknownOid(key):
+            return None
+        return self._digestOf(key)
+
+    def _hasUnknownOid(self, entries):
+        for e in entries:
+            if e is None:
+                return True
+            if type(e) in (tuple, list) and self._hasUnknownOid(e):
+                return True
+        return False
+
+    _digestByKindMap = {}
+    def regKind(kind, map=_digestByKindMap):
+        def registerFn(fn):
+            map[kind] = fn
+            return fn
+        return registerFn
+
+    @regKind('obj')
+    def _digestLoadedObj(self, obj, create=False):
+        reduction = self._asReductionMap(*self._reduceObj(obj))
+        return self._digestOfReduction(reduction, create)
+
+    @regKind('list')
+    def _digestLoadedOrdered(self, obj, create=False):
+        valueOids = self._oidsOfOrdered(obj, create)
+        if self._hasUnknownOid(valueOids):
+            return None
+        return self._digestOf(valueOids, type(obj) is not list)
+
+    @regKind('map')
+    def _digestLoadedMapping(self, obj, create=False):
+        itemOids = self._oidsOfMapping(obj.iteritems(), create)
+        if self._hasUnknownOid(itemOids):
+            return None
+        return self._digestOf(itemOids, True)
+
+    @regKind('btree')
+    def _digestLoadedBTree(self, obj, create=False):
+        return self._digestOf(self._refsOfBTree(obj, create), True)
+
+    @regKind('btreeBucket')
+    @regKind('btreeNode')
+    def _digestLoadedBucket(self, obj, create=False):
+        valueOids = self._refsOfBucket(obj, create)
+        if self._hasUnknownOid(valueOids):
+            return None
+        return self._digestOf(valueOids)
+
+    del regKind
     del regType
 
 
@@ -2,6 +2,7 @@
 #~ Imports 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+import struct
 import sqlite3
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -9,6 +10,8 @@ import sqlite3
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 initScripts = []
+# run on the connections of SQLReadPool, which only read the database
+readScripts = []
 
 def register(lst):
     def addFn(fn):
@@ -18,8 +21,12 @@ def register(lst):
 
 class ExCursor(object):
     writeOps = 0
-    def __init__(self, cur):
+    lockingMode = 'EXCLUSIVE'
+    journalMode = None
+
+    def __init__(self, cur, **options):
         self.cur = cur
+        self.__dict__.update(options)
 
     def test(self, sql):
         try:
@@ -59,18 +66,20 @@ class ExCursor(object):
             fn(self)
         return self
 
-def runScripts(cur, lst):
-    return ExCursor(cur).reduce(lst)
+def runScripts(cur, lst, **options):
+    return ExCursor(cur, **options).reduce(lst)
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 @register(initScripts)
 def sqliteSetup(ex):
     ex.run("""
-        PRAGMA locking_mode = EXCLUSIVE;
+        PRAGMA locking_mode = %s;
         PRAGMA synchronous = NORMAL;
         PRAGMA encoding = "UTF-8"; 
-        """)
+        """ % (ex.lockingMode,))
+    if ex.journalMode:
+        ex.run("PRAGMA journal_mode = %s;" % (ex.journalMode,), False)
 
 @register(initScripts)
 def createMetaTables(ex):
@@ -170,6 +179,10 @@ def createStorageTables(ex):
 
             primary key (oid) on conflict replace
         );""")
+    ex.runIfNot("select * from literals indexed by literals_value_hash limit(1);", """
+        create index if not exists literals_value_hash
+            on literals (value_type, value_hash);
+        """)
     ex.runIfNot("select * from weakrefs limit(1);", """
         create table if not exists weakrefs (
             oid_host integer,
@@ -185,11 +198,30 @@ def createStorageTables(ex):
             oid_host integer,
             oid_key integer,
             oid_value integer,
-            ssid integer
+            ssid integer,
+
+            k_tag text,
+            k_inline,
+            v_tag text,
+            v_inline
         );
         create index if not exists mappings_oid_host
             on mappings (oid_host);
         """)
+    # small literals held inline in the row, tagged by their value_type
+    ex.runIfNot("select v_tag from mappings limit(1);", """
+        alter table mappings add column k_tag text;
+        alter table mappings add column k_inline;
+        alter table mappings add column v_tag text;
+        alter table mappings add column v_inline;
+        """)
+
+    # inbound reference counts, maintained only while refcounting is on
+    ex.runIfNot("select * from refcounts limit(1);", """
+        create table if not exists refcounts (
+            oid integer primary key,
+            refs integer
+        );""")
 
 # Cross database concerns 
 @register(initScripts)
@@ -216,38 +248,63 @@ def createExternalTables(ex):
 # views for referencing through lists, mappings, and weakrefs to the oid_lookup_raw table
 @register(initScripts)
 def createLookupViews(ex):
-    ex.runIfNot("select * from lists_lookup limit(1);", """
+    # left joins against the raw lookup tables so inline rows are kept;
+    # joining oid_lookup_view here defeats sqlite's view flattening
+    ex.runIfNot("select v_tag from lists_lookup limit(1);", """
+        drop view if exists lists_lookup;
         create view lists_lookup as
             select 
                 oid_host,
                 v.oid as v_oid, 
-                v.stg_kind as v_stg_kind,
-                v.otype as v_otype
-
-            from mappings
-            join oid_lookup_view as v
-                on v.oid = oid_value;
+                vs.stg_kind as v_stg_kind,
+                vo.otype as v_otype,
+                m.v_tag as v_tag,
+                m.v_inline as v_inline
+
+            from mappings as m
+            left join oid_lookup_raw as v
+                on v.oid = m.oid_value
+            left join stg_kind_lookup as vs
+                on vs.id_stg_kind = v.id_stg_kind
+            left join otype_lookup as vo
+                on vo.id_otype = v.id_otype
+            where v.oid is not null or m.v_tag is not null;
         """)
 
-    ex.runIfNot("select * from mappings_lookup limit(1);", """
+    ex.runIfNot("select v_tag from mappings_lookup limit(1);", """
+        drop view if exists mappings_lookup;
         create view mappings_lookup as
             select 
                 oid_host,
 
                 k.oid as k_oid, 
-                k.stg_kind as k_stg_kind,
-                k.otype as k_otype,
+                ks.stg_kind as k_stg_kind,
+                ko.otype as k_otype,
+                m.k_tag as k_tag,
+                m.k_inline as k_inline,
 
                 v.oid as v_oid, 
-                v.stg_kind as v_stg_kind,
-                v.otype as v_otype
-
-            from mappings
-            join oid_lookup_view as k
-                on k.oid = oid_key
-
-            join oid_lookup_view as v
-                on v.oid = oid_value;
+                vs.stg_kind as v_stg_kind,
+                vo.otype as v_otype,
+                m.v_tag as v_tag,
+                m.v_inline as v_inline
+
+            from mappings as m
+            left join oid_lookup_raw as k
+                on k.oid = m.oid_key
+            left join stg_kind_lookup as ks
+                on ks.id_stg_kind = k.id_stg_kind
+            left join otype_lookup as ko
+                on ko.id_otype = k.id_otype
+
+            left join oid_lookup_raw as v
+                on v.oid = m.oid_value
+            left join stg_kind_lookup as vs
+                on vs.id_stg_kind = v.id_stg_kind
+            left join otype_lookup as vo
+                on vo.id_otype = v.id_otype
+            where (k.oid is not null or m.k_tag is not null)
+                and (v.oid is not null or m.v_tag is not null);
         """) 
 
     ex.runIfNot("select * from weakrefs_lookup limit(1);", """
@@ -287,12 +344,133 @@ def createReachabilityTable(ex):
         create temp table if not exists oidGraphMembers (
             oid integer,
             primary key (oid) on conflict replace
+        ); 
+        create temp table if not exists oidGraphPacked (
+            oid integer primary key
+        ); 
+        create temp table if not exists oidGraphMarked (
+            oid integer primary key
+        ); 
+        create temp table if not exists oidGraphGray (
+            oid integer primary key
         ); """)
 
+@register(readScripts)
+@register(initScripts)
+def createPrefetchTable(ex):
+    ex.run("""
+        create temp table if not exists oidPrefetch (
+            oid integer primary key,
+            lvl integer
+        ); 
+        create temp table if not exists oidPrefetchSeed (
+            oid integer primary key,
+            lvl integer
+        ); 
+        create temp table if not exists oidPrefetchPacked (
+            oid integer primary key
+        ); """, False)
+
+def prefetchReach(cur, oid, levels, limit):
+    """Fills oidPrefetch with the oids reachable from oid through at most
+    levels mappings hops, recording the shallowest level each was seen at.
+
+    The recursive query cannot see into packed containers, so their members
+    are decoded here and used to seed another round."""
+    cur.execute('''
+        delete from oidPrefetch;''')
+    cur.execute('''
+        delete from oidPrefetchPacked;''')
+    seeds = {oid: 0}
+
+    total = 0
+    while seeds and total < limit:
+        cur.execute('''
+            delete from oidPrefetchSeed;''')
+        cur.executemany('''
+            insert into oidPrefetchSeed values (?, ?)''', seeds.iteritems())
+        cur.execute('''
+            delete from oidPrefetchSeed 
+                where oid in (select oid from oidPrefetch);''')
+        total += _prefetchRound(cur, levels, limit-total)
+
+        r = cur.execute('''
+            select p.oid, p.lvl, m.v_inline 
+                from oidPrefetch as p
+                join mappings as m on m.oid_host = p.oid
+                where m.v_tag in (?, ?) and p.lvl < ?
+                    and p.oid not in (select oid from oidPrefetchPacked);''', 
+            packedTags + (levels,))
+
+        seeds = {}
+        packedHosts = []
+        for host, lvl, blob in r.fetchall():
+            packedHosts.append((host,))
+            for oid in unpackOids(blob):
+                if seeds.get(oid, levels+1) > lvl+1:
+                    seeds[oid] = lvl+1
+        cur.executemany('''
+            insert into oidPrefetchPacked values (?)''', packedHosts)
+    return total
+
+def _prefetchRound(cur, levels, limit):
+    cur.execute('''
+        insert or ignore into oidPrefetch
+            with recursive reach(oid, lvl) as (
+                select oid, lvl from oidPrefetchSeed
+                union
+                select case sel.k when 0 then m.oid_key else m.oid_value end, reach.lvl+1
+                    from reach
+                    join mappings as m on m.oid_host = reach.oid
+                    join (select 0 as k union all select 1) as sel
+                    where reach.lvl < ?
+                    limit ?)
+            select oid, min(lvl) from reach
+                where oid is not null
+                group by oid;''', (levels, limit))
+    return cur.rowcount
+
+def prefetchOidInfo(cur):
+    """Returns (oid, lvl, stg_kind, otype) for each oid in oidPrefetch;
+    stg_kind and otype are None for oids without a lookup row"""
+    # oid_lookup_view on the right of a left join is not flattened by
+    # sqlite, and would be materialized whole; join its tables directly
+    r = cur.execute('''
+        select p.oid, p.lvl, sl.stg_kind, ol.otype
+            from oidPrefetch as p
+            left join oid_lookup_raw as src 
+                on src.oid = p.oid
+            left join stg_kind_lookup as sl 
+                on sl.id_stg_kind = src.id_stg_kind
+            left join otype_lookup as ol 
+                on ol.id_otype = src.id_otype;''')
+    return r.fetchall()
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Packed containers
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# A packed container is a single mappings row whose v_tag names the format
+# and whose v_inline holds the member oids as little-endian int64s; mapping
+# keys and values are interleaved.  The version suffix allows for new
+# formats alongside these and the one-row-per-element layout.
+packedOrdered = 'packed-list:1'
+packedMapping = 'packed-map:1'
+packedTags = (packedOrdered, packedMapping)
+
+def packOids(oids):
+    return buffer(struct.pack('<%dq' % len(oids), *oids))
+
+def unpackOids(blob):
+    blob = str(blob)
+    return struct.unpack('<%dq' % (len(blob) >> 3), blob)
+
 def gcRestart(cur):
     if not cur: return False
     cur.execute('''
         delete from oidGraphMembers;''')
+    cur.execute('''
+        delete from oidGraphPacked;''')
     cur.execute('''
         insert into oidGraphMembers 
             select oid_ref from exports;''')
@@ -314,8 +492,58 @@ def gcIter(cur):
                 where oid_host in oidGraphMembers 
                     and oid_value not in oidGraphMembers;''')
     d += cur.rowcount
+    d += gcIterPacked(cur)
     return d
 
+def gcIterPacked(cur):
+    """Adds the members of packed containers reached so far, each packed
+    host being decoded only once per collection"""
+    r = cur.execute('''
+        select oid_host, v_inline from mappings
+            where v_tag in (?, ?)
+                and oid_host in oidGraphMembers
+                and oid_host not in oidGraphPacked;''', packedTags)
+    rows = r.fetchall()
+    if not rows:
+        return 0
+
+    cur.executemany('''
+        insert into oidGraphPacked values (?)''', ((host,) for host, blob in rows))
+
+    members = set()
+    for host, blob in rows:
+        members.update(unpackOids(blob))
+    cur.executemany('''
+        insert or ignore into oidGraphMembers values (?)''', ((oid,) for oid in members))
+    return len(rows) + max(0, cur.rowcount)
+
+def refcountRebuild(cur):
+    """Recounts the container rows referring to each oid"""
+    cur.execute('''
+        delete from refcounts;''')
+    cur.execute('''
+        insert into refcounts 
+            select oid, count(*) from (
+                select oid_key as oid from mappings 
+                    where oid_key is not null
+                union all
+                select oid_value as oid from mappings
+                    where oid_value is not null)
+            group by oid;''')
+
+    counts = {}
+    r = cur.execute('''
+        select v_inline from mappings 
+            where v_tag in (?, ?);''', packedTags)
+    for blob, in r.fetchall():
+        for oid in unpackOids(blob):
+            counts[oid] = counts.get(oid, 0) + 1
+    cur.executemany('''
+        insert or ignore into refcounts values (?, 0)''', ((oid,) for oid in counts))
+    cur.executemany('''
+        update refcounts set refs=refs+? where oid=?''', 
+        ((n, oid) for oid, n in counts.iteritems()))
+
 def deleteGarbage(cur):
     if not cur: return
     cur.executescript( """
@@ -323,6 +551,7 @@ def deleteGarbage(cur):
         delete from weakrefs where oid_host not in oidGraphMembers;
         delete from mappings where oid_host not in oidGraphMembers;
         delete from externals where oid not in oidGraphMembers;
+        delete from refcounts where oid not in oidGraphMembers;
         delete from exports where oid_ref not in oids;
         """)
 
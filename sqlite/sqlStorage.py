@@ -12,27 +12,435 @@
 
 import os, sys
 import uuid
+import struct
+import hashlib
+import Queue
 import sqlite3
+from itertools import chain
 from . import sqlScripts as sql
+from .lruMapping import LRUMapping
+from .gcEngines import gcEngines
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 #~ Definitions 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+class SQLWriteBuffer(object):
+    """Pending rows for SQLStorage, keyed per table so that a later write
+    to the same oid replaces the earlier one before it ever reaches sqlite."""
+
+    count = 0
+    def __init__(self):
+        self.oids = {}
+        self.oidInfo = {}
+        self.literals = {}
+        self.literalKeys = {}
+        self.mappings = {}
+        self.weakrefs = {}
+        self.externals = {}
+        self.exports = {}
+
+    def __len__(self):
+        return self.count
+
+    def flush(self, cur):
+        if self.oids:
+            cur.executemany(
+                'replace into oid_lookup_raw (oid, id_stg_kind, id_otype, ssid) '
+                '  values(?, ?, ?, ?)', self.oids.itervalues())
+        if self.literals:
+            cur.executemany(
+                'insert into literals (oid, value, value_type, value_hash, ssid)'
+                '  values(?, ?, ?, ?, ?)', self.literals.itervalues())
+        if self.mappings:
+            cur.executemany(
+                'delete from mappings '
+                '  where oid_host=?', ((oid,) for oid in self.mappings))
+            cur.executemany(
+                'insert into mappings (oid_host, oid_key, k_tag, k_inline, '
+                '    oid_value, v_tag, v_inline, ssid) '
+                '  values(?, ?, ?, ?, ?, ?, ?, ?)',
+                chain(*self.mappings.itervalues()))
+        if self.weakrefs:
+            cur.executemany(
+                'insert into weakrefs (oid_host, oid_ref, ssid)'
+                '  values(?, ?, ?)', self.weakrefs.itervalues())
+        if self.externals:
+            cur.executemany(
+                'insert into externals (oid, url, ssid)'
+                '  values(?, ?, ?)', self.externals.itervalues())
+        if self.exports:
+            cur.executemany(
+                "replace into exports (urlpath, oid_ref, ssid)"
+                "  values(?,?,?)", self.exports.itervalues())
+            cur.executemany(
+                "insert into oidGraphMembers values (?)", 
+                ((e[1],) for e in self.exports.itervalues()))
+        return self.count
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def unpackRows(tag, blob):
+    """(oid_key, oid_value) rows of a packed container"""
+    oids = sql.unpackOids(blob)
+    if tag == sql.packedOrdered:
+        return [(None, oid_v) for oid_v in oids]
+    elif tag == sql.packedMapping:
+        oids = iter(oids)
+        return zip(oids, oids)
+    else: 
+        raise ValueError("Unknown packed container format: %r" % (tag,))
+
+class SQLRowCache(object):
+    """Rows for a reachable subgraph, fetched with a handful of set-based
+    queries and consulted by SQLStorage before issuing per-oid queries.
+
+    Only hosts whose mappings were fetched completely are cached; a host
+    whose referenced oids are not all known falls back to sqlite.  Inline
+    values are held as ready load entries in place of their oid."""
+
+    count = nRows = 0
+    ssids = None
+    def __init__(self, inlineEntry):
+        self.inlineEntry = inlineEntry
+        self.oidInfo = {}
+        self.mappings = {}
+        self.literals = {}
+        self.weakrefs = {}
+        self.urlPaths = {}
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, oid):
+        return oid in self.mappings
+
+    def discard(self, oid):
+        self.oidInfo.pop(oid, None)
+        self.mappings.pop(oid, None)
+        self.literals.pop(oid, None)
+        self.weakrefs.pop(oid, None)
+        self.urlPaths.pop(oid, None)
+        if self.ssids is not None:
+            self.ssids.pop(oid, None)
+
+    def update(self, other):
+        self.oidInfo.update(other.oidInfo)
+        self.mappings.update(other.mappings)
+        self.literals.update(other.literals)
+        self.weakrefs.update(other.weakrefs)
+        self.urlPaths.update(other.urlPaths)
+        self.nRows += other.nRows
+        self.count = self.nRows + len(self.oidInfo) + len(self.literals)
+
+    def prefetch(self, cur, oid, levels, limit, ssids=None):
+        sql.prefetchReach(cur, oid, levels, limit)
+        if ssids is not None:
+            ssids.update(cur.execute(
+                'select oid, ssid from oid_lookup_raw '
+                '  where oid in (select oid from oidPrefetch)'))
+
+        oidInfo = self.oidInfo
+        hosts = []
+        for oid, lvl, stg_kind, otype in sql.prefetchOidInfo(cur):
+            if stg_kind is not None:
+                oidInfo[oid] = (stg_kind, otype)
+            if lvl < levels:
+                hosts.append(oid)
+
+        rows = dict((host, []) for host in hosts)
+        inlineEntry = self.inlineEntry
+        r = cur.execute(
+            'select oid_host, oid_key, k_tag, k_inline, oid_value, v_tag, v_inline '
+            '  from mappings '
+            '  where oid_host in (select oid from oidPrefetch where lvl < ?) '
+            '  order by oid_host, tidx', (levels,))
+        for host, oid_k, k_tag, k_inline, oid_v, v_tag, v_inline in r:
+            if v_tag in sql.packedTags:
+                rows[host].extend(unpackRows(v_tag, v_inline))
+                continue
+            if k_tag is not None:
+                oid_k = inlineEntry(k_tag, k_inline)
+            if v_tag is not None:
+                oid_v = inlineEntry(v_tag, v_inline)
+            rows[host].append((oid_k, oid_v))
+
+        # only stage hosts whose every referenced oid is known
+        nRows = 0
+        mappings = self.mappings
+        for host, hostRows in rows.iteritems():
+            for oid_k, oid_v in hostRows:
+                if not self._isKnown(oid_v) or (oid_k is not None and not self._isKnown(oid_k)):
+                    break
+            else:
+                mappings[host] = hostRows
+                nRows += len(hostRows)
+
+        literals = self.literals
+        r = cur.execute(
+            'select oid, value, value_type from literals '
+            '  where oid in (select oid from oidPrefetch)')
+        for oid, value, value_type in r:
+            literals[oid] = (value, value_type)
+
+        weakrefs = self.weakrefs
+        r = cur.execute(
+            'select oid_host, v_oid, v_stg_kind, v_otype from weakrefs_lookup '
+            '  where oid_host in (select oid from oidPrefetch)')
+        for e in r:
+            weakrefs[e[0]] = e[1:]
+
+        self.nRows += nRows
+        self.count = self.nRows + len(oidInfo) + len(literals)
+        return self
+
+    def _isKnown(self, ref):
+        return type(ref) is tuple or ref in self.oidInfo
+
+    def _entry(self, ref):
+        if type(ref) is tuple:
+            return ref
+        return (ref,)+self.oidInfo[ref]
+
+    def getOrdered(self, oid):
+        rows = self.mappings.get(oid)
+        if rows is None:
+            return None
+
+        entry = self._entry
+        try:
+            return [entry(oid_v) for oid_k, oid_v in rows]
+        except KeyError:
+            return None
+
+    def getMapping(self, oid):
+        rows = self.mappings.get(oid)
+        if rows is None:
+            return None
+
+        entry = self._entry
+        try:
+            return [(entry(oid_k), entry(oid_v)) for oid_k, oid_v in rows]
+        except KeyError:
+            return None
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class SQLReadPool(object):
+    """Connections that only read a WAL database, each checked out by the
+    thread fetching rows, so that fetches for loads run in parallel with
+    each other and with the writer.
+
+    Fetched rows are tagged with SQLStorage.commitSerial as of the fetch;
+    SQLStorage.stageRows drops those the writer has changed since."""
+
+    def __init__(self, stg, size):
+        self.stg = stg
+        self.idle = Queue.Queue()
+        for i in xrange(size):
+            db = sqlite3.connect(stg.dbFilename, stg.busyTimeout,
+                    check_same_thread=False)
+            db.text_factory = str
+            sql.runScripts(db.cursor(), sql.readScripts, lockingMode='NORMAL')
+            self.idle.put(db)
+        self.size = size
+
+    def close(self):
+        for i in xrange(self.size):
+            self.idle.get().close()
+        self.size = 0
+
+    def run(self, fn, *args, **kw):
+        """Calls fn(cursor, ...) on an idle connection, waiting for one to
+        become idle if need be"""
+        db = self.idle.get()
+        try:
+            try:
+                return fn(db.cursor(), *args, **kw)
+            finally:
+                # ends the read transaction, releasing its snapshot
+                db.commit()
+        finally:
+            self.idle.put(db)
+
+    def prefetch(self, key, levels, limit):
+        """Returns (serial, SQLRowCache) for the subgraph at key, an oid or
+        urlpath, or None if key is not found"""
+        return self.run(self._prefetch, key, levels, limit)
+
+    def _prefetch(self, cur, key, levels, limit):
+        stg = self.stg
+        serial = stg.commitSerial
+        cache = SQLRowCache(stg.inlineEntry)
+        if stg.multiWriter:
+            cache.ssids = {}
+        if isinstance(key, basestring):
+            entry = cur.execute(
+                "select oid, stg_kind, otype from exports_lookup"
+                "  where urlpath=?", (key,)).fetchone()
+            if entry is None:
+                return None
+            cache.urlPaths[key] = entry
+            key = entry[0]
+        cache.prefetch(cur, key, levels, limit, cache.ssids)
+        return serial, cache
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class SQLLiteralCache(object):
+    """Bounded LRU of (value_type, value_hash) to the [(oid, value)] of
+    the literals sharing that hash.
+
+    Each value_type is preloaded on first use.  While a type has been
+    loaded completely and nothing has been evicted, a miss is authoritative
+    and needs no query at all."""
+
+    nEvicted = 0
+    # False when other writers may add literals behind this cache's back
+    trustMisses = True
+    def __init__(self, size):
+        self.size = size
+        self.entries = LRUMapping()
+        self.loadedTypes = set()
+        self.completeTypes = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, value_type, value_hash):
+        key = (value_type, value_hash)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+        return entry
+
+    def add(self, value_type, value_hash, oid, value):
+        key = (value_type, value_hash)
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            entry = []
+        entry.append((oid, value))
+        self.entries[key] = entry
+        self._trim()
+
+    def discard(self, value_type, value_hash, oid):
+        key = (value_type, value_hash)
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[:] = [e for e in entry if e[0] != oid]
+            if not entry:
+                del self.entries[key]
+
+    def isComplete(self, value_type):
+        return value_type in self.completeTypes
+
+    def preload(self, value_type, rows):
+        self.loadedTypes.add(value_type)
+        nEvicted = self.nEvicted
+        for oid, value, value_hash in rows:
+            self.add(value_type, value_hash, oid, value)
+        if not self.trustMisses:
+            return
+        if len(rows) <= self.size and nEvicted == self.nEvicted:
+            self.completeTypes.add(value_type)
+
+    def _trim(self):
+        entries = self.entries
+        if len(entries) > self.size:
+            # misses are no longer conclusive once anything is evicted
+            self.completeTypes.clear()
+            while len(entries) > self.size:
+                entries.popitem(False)
+                self.nEvicted += 1
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class WriteConflict(Exception):
+    """Another session wrote oids since this session read them"""
+    def __init__(self, oids):
+        Exception.__init__(self, 
+            'Oids written by another session: %r' % (oids[:10],))
+        self.oids = oids
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
 class SQLStorage(object):
     nextOid = None
     _sql_init = sql.initScripts
 
+    # Number of pending rows collected before an executemany flush.  Set
+    # to 0 or None to issue each write immediately.
+    writeBufferSize = 10000
+    _wbuf = None
+
+    # Bounds for subgraph prefetching: oids gathered per prefetch, and
+    # rows held before the row cache is started afresh.
+    prefetchLimit = 10000
+    rowCacheSize = 100000
+    _rowCache = None
+
+    # Containers of at least packedMinLen elements that are all oids are
+    # written as one packed row instead of a row per element.  Set to 0 or
+    # None to always write one row per element.
+    packedMinLen = 64
+
+    # Row-format containers of at least deltaMinLen elements are rewritten
+    # as a diff against their persisted rows -- appends, truncations, and
+    # per-row updates and deletes -- instead of a delete and full reinsert.
+    # Set to 0 or None to always rewrite every row.
+    deltaMinLen = 256
+
+    # Count the container rows referring to each oid, and reclaim oids
+    # whose count drops to zero when the transaction commits.  Tracing
+    # collection is then only needed for unreachable cycles.
+    refcounting = False
+    _rcZero = None
+
+    # Literal dedup keys held in memory by the LRU intern cache
+    literalCacheSize = 50000
+    _literalCache = None
+
+    # Run in WAL journal mode with normal locking, so that other connections
+    # can read a snapshot while this one writes; the concurrent collector
+    # depends on it.
+    walMode = False
+
+    # Connections kept by SQLReadPool when walMode is on; 0 or None for
+    # none.  commitSerial counts the commits made while a pool is open,
+    # and the keys written by each of the last readPoolCommits commits
+    # are kept to screen rows fetched by the pool.
+    readPoolSize = 0
+    readPoolCommits = 64
+    readPool = None
+    commitSerial = 0
+    _txnKeys = None
+
+    # Let several processes write the file at once.  Locking is normal
+    # and WAL journaling is used; each session leases oidLeaseSize oids at
+    # a time under BEGIN IMMEDIATE, and a flush raises WriteConflict for
+    # oids another session wrote since this one read them, judged by the
+    # ssid of their rows.  Collection and refcounting assume one writer.
+    multiWriter = False
+    oidLeaseSize = 1000
+    busyTimeout = 5.0
+    _oidLeaseEnd = None
+    _oidLeaseInTxn = None
+    _readSsids = None
+    _claims = None
+    _writing = False
+
     def __init__(self, filename, dbid=None):
         filename = os.path.abspath(filename)
         self.dbFilename = filename
-        db = sqlite3.connect(filename)
+        db = sqlite3.connect(filename, self.busyTimeout)
         db.isolation_level = "DEFERRED"
 
         db.text_factory = str
 
         self.db = db
         self._cursor = db.cursor()
+        if self.writeBufferSize:
+            self._wbuf = SQLWriteBuffer()
         self.initialize()
 
         if self.dbid is None:
@@ -46,17 +454,38 @@ class SQLStorage(object):
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def close(self):
+        pool = self.readPool
+        if pool is not None:
+            self.readPool = None
+            pool.close()
+        engine = self._gcIncremental
+        if engine is not None:
+            self._gcIncremental = None
+            engine.abandon()
+        self._wbuf = None
+        self._rowCache = None
+        self._literalCache = None
         self._cursor = None
         self.db.close()
         self.db = None
 
     def initialize(self):
-        exCur = sql.runScripts(self.readCursor, self._sql_init)
+        exCur = sql.runScripts(self.readCursor, self._sql_init, 
+                    **self._sqlOptions())
 
         self.fetchMetadata()
         self.nextOid = self.getMetaAttr('nextOid', 1000)
         if exCur.writeOps:
             self.newSession(self._cursor)
+        self.migrateLiteralHashes()
+        self.initRefcounts()
+        self.initOidLeases()
+        self.initReadPool()
+
+    def _sqlOptions(self):
+        if self.walMode or self.multiWriter:
+            return dict(lockingMode='NORMAL', journalMode='WAL')
+        return {}
 
     def fetchMetadata(self):
         self._metadata = dict()
@@ -104,6 +533,8 @@ class SQLStorage(object):
         if session is None and self.writable:
             session = uuid.uuid4() # new random uuid
             self.session = session
+            if self.multiWriter:
+                self.beginWrite()
             r = writeCursor.execute(
                 'insert into odb_sessions values (NULL, ?, ?)',
                 (str(session), self.nextOid))
@@ -114,23 +545,292 @@ class SQLStorage(object):
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     def getReadCursor(self):
+        if self._wbuf: 
+            self.flushWrites()
         r = self._cursor
         return r
     readCursor = property(getReadCursor)
 
     def getWriteCursor(self):
+        if self._wbuf: 
+            self.flushWrites()
         r = self._cursor
         if self.session is None:
             if not self.newSession(r):
                 r = None
+        if self.multiWriter:
+            self.beginWrite()
         return r
     writeCursor = property(getWriteCursor)
 
+    def getDirectCursor(self):
+        """A write cursor that leaves the write buffer pending; for rows
+        the buffer holds nothing for"""
+        if self.writeBuffer is None:
+            return self.writeCursor
+        if self.multiWriter:
+            self.beginWrite()
+        return self._cursor
+    directCursor = property(getDirectCursor)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Write buffering
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def getWriteBuffer(self):
+        wbuf = self._wbuf
+        if wbuf is not None and self.session is None:
+            if not self.newSession(self._cursor):
+                return None
+        return wbuf
+    writeBuffer = property(getWriteBuffer)
+
+    def _wbufAdded(self, wbuf, count=1):
+        wbuf.count += count
+        if wbuf.count >= self.writeBufferSize:
+            self.flushWrites()
+
+    def flushWrites(self):
+        wbuf = self._wbuf
+        if self.multiWriter and (wbuf or self._claims):
+            # a read transaction cannot be upgraded once another session
+            # has committed; write on a current snapshot under the lock
+            self.beginWrite()
+        if self._claims:
+            self.claimOids()
+        if not wbuf: 
+            return 0
+
+        # the rows stay pending should the flush fail
+        count = wbuf.flush(self._cursor)
+        self._wbuf = SQLWriteBuffer()
+        return count
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Prefetching
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-    def commit(self):
-        self.setMetaAttr('nextOid', self.nextOid)
+    def prefetch(self, oid, levels):
+        """Stages the rows reachable from oid within levels mappings hops
+        in the row cache; a no-op if oid's rows are already staged"""
+        cache = self._rowCache
+        if cache is not None:
+            if oid in cache:
+                return cache
+            if len(cache) > self.rowCacheSize:
+                cache = None
+        if cache is None:
+            cache = SQLRowCache(self.inlineEntry)
+
+        cache.prefetch(self.readCursor, oid, levels, self.prefetchLimit, 
+                self._readSsids)
+        self._rowCache = cache
+        return cache
+
+    def clearRowCache(self):
+        self._rowCache = None
+
+    def _discardCachedRows(self, oid):
+        cache = self._rowCache
+        if cache is not None:
+            cache.discard(oid)
+        if self._txnKeys is not None:
+            self._txnKeys.add(oid)
+        if self._claims is not None and isinstance(oid, (int, long)):
+            self._claims.add(oid)
+            if self._wbuf is None:
+                self.claimOids()
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Read pool
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def initReadPool(self):
+        if self.walMode and self.readPoolSize:
+            self._txnKeys = set()
+            self._commitLog = []
+            self.readPool = SQLReadPool(self, self.readPoolSize)
+
+    def stageRows(self, staged):
+        """Adds rows fetched by the read pool to the row cache, less those
+        written by this connection since their commitSerial"""
+        serial, cache = staged
+        log = self._commitLog
+        if log and log[0][0] > serial+1:
+            # commits made since the fetch are no longer all logged
+            return False
+
+        for commit, keys in log:
+            if commit > serial:
+                for key in keys:
+                    cache.discard(key)
+        for key in self._txnKeys:
+            cache.discard(key)
+        if cache.ssids:
+            self._readSsids.update(cache.ssids)
+            cache.ssids = None
+
+        current = self._rowCache
+        if current is None or len(current) > self.rowCacheSize:
+            self._rowCache = cache
+        else: current.update(cache)
+        return True
+
+    def _logCommit(self):
+        if self._txnKeys is None:
+            return
+        self.commitSerial += 1
+        log = self._commitLog
+        log.append((self.commitSerial, self._txnKeys))
+        self._txnKeys = set()
+        del log[:-self.readPoolCommits]
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Multiple writers
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def initOidLeases(self):
+        if not self.multiWriter or not self.writable:
+            return
+        self._readSsids = {}
+        self._claims = set()
+        self._txnOids = set()
+        self.leaseOids()
+        self.db.commit()
+        self._commitLeases()
+
+    def beginWrite(self):
+        """Takes the write lock for the rest of the transaction, waiting up
+        to busyTimeout for other writers to commit"""
+        if self._writing:
+            return
+        # a transaction opened by reads holds only temp table rows; ending
+        # it starts the write transaction on a current snapshot
         self.db.commit()
+        self._cursor.execute('begin immediate')
+        self._writing = True
+
+    def leaseOids(self):
+        """Reserves the next oidLeaseSize unused oids for this session"""
+        size = self.oidLeaseSize
+        self.beginWrite()
+        r = self._cursor
+        r.execute(
+            "update odb_metadata set value=value+? "
+            "  where attr='nextOid'", (size,))
+        if r.rowcount == 0:
+            r.execute(
+                "insert into odb_metadata (attr, value) "
+                "  values ('nextOid', ?)", (self.nextOid+size,))
+        end, = r.execute(
+            "select value from odb_metadata "
+            "  where attr='nextOid'").fetchone()
+        r.execute(
+            'update odb_sessions set nextOid=? '
+            '  where ssid=?', (end, self.ssid))
+
+        self._metadata['nextOid'] = end
+        self.nextOid = end - size
+        self._oidLeaseEnd = end
+        # until committed, the lease is lost if the transaction is
+        self._oidLeaseInTxn = self.nextOid
+
+    def _commitLeases(self):
+        self._writing = False
+        self._oidLeaseInTxn = None
+        self._txnOids = set()
+        end = self._oidLeaseEnd
+        if end is not None and end - self.nextOid < self.oidLeaseSize//4:
+            # lease ahead while no transaction is open
+            self.leaseOids()
+            self.db.commit()
+            self._writing = False
+            self._oidLeaseInTxn = None
+
+    def claimOids(self, chunkSize=500):
+        """Checks the oids written since the last claim before their rows
+        are: raises WriteConflict, after rolling back, if another session
+        wrote any of them after this session read it, and otherwise stamps
+        their oid rows with this session's ssid"""
+        oids = list(self._claims)
+        self._claims.clear()
+        self.beginWrite()
+
+        seen = self._readSsids
+        known = [oid for oid in oids if oid in seen]
+        conflicts = []
+        r = self._cursor
+        for i in xrange(0, len(known), chunkSize):
+            chunk = known[i:i+chunkSize]
+            r.execute(
+                'select oid, ssid from oid_lookup_raw '
+                '  where oid in (%s)' % (','.join('?'*len(chunk)),), chunk)
+            conflicts.extend(oid for oid, ssid in r if ssid != seen[oid])
+        if conflicts:
+            self._txnOids.update(oids)
+            self.abortWrites(conflicts)
+            raise WriteConflict(conflicts)
+
+        ssid = self.ssid
+        for i in xrange(0, len(oids), chunkSize):
+            chunk = oids[i:i+chunkSize]
+            r.execute(
+                'update oid_lookup_raw set ssid=? '
+                '  where oid in (%s)' % (','.join('?'*len(chunk)),), 
+                [ssid]+chunk)
+        for oid in oids:
+            seen[oid] = ssid
+        self._txnOids.update(oids)
+
+    def abortWrites(self, conflicts=()):
+        """Rolls back the open transaction.  The other oids written in it
+        are marked dirty again, and the conflicting ones forgotten so that
+        loading them reads the other session's version."""
+        self.db.rollback()
+        self._writing = False
+        self._claims.clear()
+        if self._wbuf is not None:
+            self._wbuf = SQLWriteBuffer()
+        self._rowCache = None
+        self._literalCache = None
+        self._stgKindMap = None
+        self._otypeMap = None
+
+        written = self._txnOids
+        self._txnOids = set()
+        leaseStart = self._oidLeaseInTxn
+        if leaseStart is not None:
+            # the rolled back lease may be handed to another session
+            self._oidLeaseInTxn = None
+            leased = xrange(leaseStart, self.nextOid)
+            written.difference_update(leased)
+            self.forgetOids(leased)
+            self._oidLeaseEnd = self.nextOid
+
+        seen = self._readSsids
+        for oid in conflicts:
+            seen.pop(oid, None)
+            written.discard(oid)
+        self.forgetOids(conflicts)
+        if self.oidToObj is not None:
+            self.oidToObj.discardURLPaths()
+        self.invalidateOids(list(written)+list(conflicts))
+        if self.dirtyOids is not None:
+            self.dirtyOids.update(written)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def commit(self):
+        self.flushWrites()
+        if self._rcZero:
+            self.refcountReclaim()
+        if self.multiWriter:
+            self.db.commit()
+            self._commitLeases()
+        else:
+            self.setMetaAttr('nextOid', self.nextOid)
+            self.db.commit()
+        self._logCommit()
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -145,13 +845,32 @@ class SQLStorage(object):
         return r.fetchall()
 
     def getOidInfo(self, oid):
-        r = self.readCursor.execute(
-            'select stg_kind, otype '
+        wbuf = self._wbuf
+        if wbuf:
+            info = wbuf.oidInfo.get(oid)
+            if info is not None:
+                return info
+
+        cache = self._rowCache
+        if cache is not None:
+            info = cache.oidInfo.get(oid)
+            if info is not None:
+                return info
+
+        # pending rows for other oids cannot change the answer
+        r = self._cursor.execute(
+            'select stg_kind, otype, ssid '
             '  from oid_lookup_view where oid=?', (oid,))
-        return r.fetchone()
+        r = r.fetchone()
+        if r is not None:
+            if self._readSsids is not None:
+                self._readSsids[oid] = r[2]
+            return r[:2]
 
     def setOid(self, oid, stg_kind, otype):
         if oid is None:
+            if self.multiWriter and self.nextOid >= self._oidLeaseEnd:
+                self.leaseOids()
             oid = self.nextOid
             self.nextOid = oid+1
 
@@ -162,6 +881,15 @@ class SQLStorage(object):
 
         id_stg_kind = self._stgKindKeyFor(stg_kind)
         id_otype = self._otypeKeyFor(otype)
+        self._discardCachedRows(oid)
+        self.gcBarrier((oid,))
+
+        wbuf = self.writeBuffer
+        if wbuf is not None:
+            wbuf.oids[oid] = (oid, id_stg_kind, id_otype, self.ssid)
+            wbuf.oidInfo[oid] = (stg_kind, otype)
+            self._wbufAdded(wbuf)
+            return oid
 
         r = self.writeCursor
         r.execute(
@@ -187,6 +915,11 @@ class SQLStorage(object):
             w = self.writeCursor
             w.execute('insert into stg_kind_lookup values (NULL, ?)', (stg_kind,))
             id_stg_kind = w.lastrowid
+            if w.rowcount != 1:
+                # ignored; another writer added it first
+                id_stg_kind, = w.execute(
+                    'select id_stg_kind from stg_kind_lookup '
+                    '  where stg_kind=?', (stg_kind,)).fetchone()
             self.stgKindMap[stg_kind] = id_stg_kind
         return id_stg_kind
 
@@ -206,12 +939,41 @@ class SQLStorage(object):
             w = self.writeCursor
             w.execute('insert into otype_lookup values (NULL, ?)', (otype,))
             id_otype = w.lastrowid
+            if w.rowcount != 1:
+                # ignored; another writer added it first
+                id_otype, = w.execute(
+                    'select id_otype from otype_lookup '
+                    '  where otype=?', (otype,)).fetchone()
             self.otypeMap[otype] = id_otype
         return id_otype
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+    oidDigests = None
+    dirtyOids = None
+    oidToObj = None
+    objToOid = None
+
+    def forgetOids(self, oids):
+        """Drops swept oids from the identity maps, so that an object still
+        held in memory is stored afresh under a new oid"""
+        oidToObj = self.oidToObj
+        if oidToObj is None:
+            return
+        for oid in oids:
+            obj = oidToObj[oid]
+            oidToObj.remove(oid, obj)
+            if obj is not None:
+                self.objToOid.remove(obj)
+
+    def invalidateOids(self, oids=None):
+        """Forget cached state for oids whose rows were removed; None for all"""
+        digests = self.oidDigests
+        if digests is not None:
+            digests.invalidate(oids)
+
     def removeOid(self, oid):
+        self.refcountUpdate(oid, ())
         r = self.writeCursor
         r.execute(
             'delete from oid_lookup_raw where oid=?', (oid,))
@@ -219,6 +981,8 @@ class SQLStorage(object):
             'delete from exports where oid_ref=?', (oid,))
         r.execute(
             'delete from mappings where oid_host=?', (oid,))
+        self._discardCachedRows(oid)
+        self.invalidateOids([oid])
 
     def allURLPaths(self, incOid=True):
         if incOid:
@@ -231,14 +995,35 @@ class SQLStorage(object):
             return [e[0] for e in r.fetchall()]
 
     def getAtURLPath(self, urlpath):
+        cache = self._rowCache
+        if cache is not None:
+            entry = cache.urlPaths.get(urlpath)
+            if entry is not None:
+                return entry
+
         r = self.readCursor.execute(
             "select oid, stg_kind, otype from exports_lookup"
             "  where urlpath=?", (urlpath,))
-        return r.fetchone()
+        entry = r.fetchone()
+        if entry is not None and self._readSsids is not None:
+            self.getOidInfo(entry[0])
+        return entry
 
     def setURLPathForOid(self, urlpath, oid):
         if not urlpath: 
             return
+        self.gcBarrier((oid,))
+        self._discardCachedRows(urlpath)
+        if self._claims is not None:
+            # the export is written against the version of oid read here,
+            # even when oid's own rows are not rewritten
+            self._claims.add(oid)
+
+        wbuf = self.writeBuffer
+        if wbuf is not None:
+            wbuf.exports[urlpath] = (urlpath, oid, self.ssid)
+            self._wbufAdded(wbuf)
+            return
 
         r = self.writeCursor
         r.execute(
@@ -247,22 +1032,75 @@ class SQLStorage(object):
         r.execute(
             """insert into oidGraphMembers values (?)""", (oid,))
 
+    def getLiteralCache(self):
+        cache = self._literalCache
+        if cache is None:
+            cache = SQLLiteralCache(self.literalCacheSize)
+            cache.trustMisses = not self.multiWriter
+            self._literalCache = cache
+        return cache
+    literalCache = property(getLiteralCache)
+
     def findLiteral(self, value, value_hash, value_type):
+        """Returns the oid of an existing literal equal to value, comparing
+        values since distinct literals may share a value_hash"""
+        cache = self.literalCache
+        if value_type not in cache.loadedTypes:
+            self._preloadLiterals(cache, value_type)
+
+        entry = cache.get(value_type, value_hash)
+        if entry is not None:
+            for oid, v in entry:
+                if v == value:
+                    return oid
+        if cache.isComplete(value_type):
+            return None
+
+        wbuf = self._wbuf
+        if wbuf:
+            for oid in wbuf.literalKeys.get((value_hash, value_type), ()):
+                e = wbuf.literals[oid]
+                if self.decodeLiteral(e[1], value_type) == value:
+                    return oid
+
+        # pending rows for other literals cannot change the answer
+        r = self._cursor.execute(
+            'select oid, value from literals '
+            '  where value_type=? and value_hash=?',
+            (value_type, value_hash))
+        for oid, v in r.fetchall():
+            v = self.decodeLiteral(v, value_type)
+            cache.add(value_type, value_hash, oid, v)
+            if v == value:
+                return oid
+
+    def _preloadLiterals(self, cache, value_type):
         r = self.readCursor.execute(
-            'select oid from literals '
-            '  where value_hash=? and value_type=?',
-            (value_hash, value_type))
-        r = r.fetchone()
-        if r is not None:
-            return r[0]
+            'select oid, value, value_hash from literals '
+            '  where value_type=? limit ?', (value_type, cache.size+1))
+        decode = self.decodeLiteral
+        cache.preload(value_type, [(oid, decode(v, value_type), h) for oid, v, h in r])
+
+    def _getCachedLiteral(self, oid):
+        cache = self._rowCache
+        if cache is not None:
+            return cache.literals.get(oid)
 
     def getLiteralAndType(self, oid):
+        entry = self._getCachedLiteral(oid)
+        if entry is not None:
+            return self.decodeLiteralEntry(entry)
+
         r = self.readCursor.execute(
             'select value, value_type '
             '  from literals where oid=?', (oid,))
         return self.decodeLiteralEntry(r.fetchone())
 
     def getLiteral(self, oid):
+        entry = self._getCachedLiteral(oid)
+        if entry is not None:
+            return self.decodeLiteralEntry(entry)
+
         r = self.readCursor.execute(
             'select value, value_type from literals ' 
             '  where oid=?', (oid,))
@@ -273,15 +1111,85 @@ class SQLStorage(object):
         if oid is not None:
             return oid
 
+        oid = self.setOid(None, stg_kind, value_type)
+        self.literalCache.add(value_type, value_hash, oid, value)
         value = self.encodeLiteral(value, value_type)
 
+        wbuf = self.writeBuffer
+        if wbuf is not None:
+            wbuf.literals[oid] = (oid, value, value_type, value_hash, self.ssid)
+            wbuf.literalKeys.setdefault((value_hash, value_type), []).append(oid)
+            self._wbufAdded(wbuf)
+            return oid
+
         r = self.writeCursor
-        oid = self.setOid(None, stg_kind, value_type)
         r.execute(
             'insert into literals (oid, value, value_type, value_hash, ssid)'
             '  values(?, ?, ?, ?, ?)', (oid, value, value_type, value_hash, self.ssid))
         return oid
 
+    # Version of hashLiteral recorded in odb_metadata; literals written under
+    # an older version, or python's hash(), are rehashed on open.
+    literalHashVersion = 1
+    literalHashKey = 'TG.objdbs.sqlite.literal'
+    literalHashChunk = 10000
+
+    def hashLiteral(self, value, value_type):
+        """Stable 64-bit content hash of a literal, independent of the
+        process, platform and python hash randomization"""
+        value = self.encodeLiteral(value, value_type)
+        return self._hashEncodedLiteral(value, value_type)
+
+    def _hashEncodedLiteral(self, value, value_type):
+        tv = type(value)
+        if tv in (int, long, bool):
+            value = '%d' % (value,)
+        elif tv is float:
+            value = repr(value)
+        elif tv is unicode:
+            value = value.encode('utf-8')
+        else: value = str(value)
+
+        h = hashlib.md5(self.literalHashKey)
+        h.update(value_type)
+        h.update('\x00')
+        h.update(value)
+        return struct.unpack('<q', h.digest()[:8])[0]
+
+    def migrateLiteralHashes(self):
+        """Rehashes the literals table with hashLiteral, literalHashChunk
+        rows per transaction, resuming from the last oid rehashed"""
+        version = self.getMetaAttr('literalHash')
+        if version == self.literalHashVersion or not self.writable:
+            return 0
+
+        total = 0
+        lastOid = self.getMetaAttr('literalHashOid', -1)
+        hashEncoded = self._hashEncodedLiteral
+        while 1:
+            r = self.writeCursor
+            rows = r.execute(
+                'select oid, value, value_type from literals '
+                '  where oid > ? order by oid limit ?', 
+                (lastOid, self.literalHashChunk)).fetchall()
+            if not rows: 
+                break
+
+            r.executemany(
+                'update literals set value_hash=? where oid=?', 
+                [(hashEncoded(value, value_type), oid) for oid, value, value_type in rows])
+            lastOid = rows[-1][0]
+            total += len(rows)
+            self.setMetaAttr('literalHashOid', lastOid)
+            self.db.commit()
+
+        self.setMetaAttr('literalHash', self.literalHashVersion)
+        self.delMetaAttr('literalHashOid')
+        self._metadata.pop('literalHashOid', None)
+        self.db.commit()
+        self._literalCache = None
+        return total
+
     def encodeLiteral(self, value, value_type):
         if value_type == 'unicode':
             value = value.encode('utf-8')
@@ -299,6 +1207,27 @@ class SQLStorage(object):
             value = str(value)
         return value
 
+    _inlineTypes = {'bool': bool, 'int': int, 'float': float}
+    def inlineEntry(self, tag, value):
+        """Load entry for a literal held inline in a mappings row"""
+        fn = self._inlineTypes.get(tag)
+        if fn is not None:
+            value = fn(value)
+        else: value = self.decodeLiteral(value, tag)
+        return (None, 'inline', value)
+
+    def _refColumns(self, ref):
+        # container refs are an oid, or a (value_type, value) inline literal
+        if type(ref) is tuple:
+            tag, value = ref
+            return (None, tag, self.encodeLiteral(value, tag))
+        return (ref, None, None)
+
+    def _mappingRows(self, oid, itemRefs):
+        ssid = self.ssid
+        cols = self._refColumns
+        return [(oid,)+cols(k)+cols(v)+(ssid,) for k, v in itemRefs]
+
     def getExternal(self, oid):
         r = self.readCursor.execute(
             'select url from externals '
@@ -307,6 +1236,12 @@ class SQLStorage(object):
         if r is not None:
             return r[0]
     def setExternal(self, oid, url):
+        wbuf = self.writeBuffer
+        if wbuf is not None:
+            wbuf.externals[oid] = (oid, url, self.ssid)
+            self._wbufAdded(wbuf)
+            return oid
+
         r = self.writeCursor
         r.execute(
             'insert into externals (oid, url, ssid)'
@@ -314,11 +1249,24 @@ class SQLStorage(object):
         return oid
 
     def getWeakref(self, oid):
+        cache = self._rowCache
+        if cache is not None:
+            entry = cache.weakrefs.get(oid)
+            if entry is not None:
+                return entry
+
         r = self.readCursor.execute(
             'select v_oid, v_stg_kind, v_otype from weakrefs_lookup '
             '  where oid=?', (oid,))
         return r.fetchone()
     def setWeakref(self, oid, oid_ref):
+        self._discardCachedRows(oid)
+        wbuf = self.writeBuffer
+        if wbuf is not None:
+            wbuf.weakrefs[oid] = (oid, oid_ref, self.ssid)
+            self._wbufAdded(wbuf)
+            return oid
+
         r = self.writeCursor
         r.execute(
             'insert into weakrefs (oid_host, oid_ref, ssid)'
@@ -326,46 +1274,487 @@ class SQLStorage(object):
         return oid
 
     def getOrdered(self, oid):
+        cache = self._rowCache
+        if cache is not None:
+            result = cache.getOrdered(oid)
+            if result is not None:
+                return result
+
         r = self.readCursor.execute(
             'select '
-            '    v_oid, v_stg_kind, v_otype '
+            '    v_oid, v_stg_kind, v_otype, v_tag, v_inline '
             '  from lists_lookup where oid_host=?', (oid,))
-        return r.fetchall()
-    def setOrdered(self, oid, valueOids):
-        r = self.writeCursor
-        r.execute(
-            'delete from mappings '
-            '  where oid_host=?', (oid,))
+        rows = r.fetchall()
+        if len(rows) == 1 and rows[0][3] == sql.packedOrdered:
+            return [e for k, e in self._unpackEntries(rows[0][3], rows[0][4])]
 
-        ssid = self.ssid
-        r.executemany(
-            'insert into mappings values(NULL, ?, NULL, ?, ?)',
-            ((oid, oid_v, ssid) for oid_v in valueOids))
-        return oid
+        inlineEntry = self.inlineEntry
+        return [e[:3] if e[3] is None else inlineEntry(e[3], e[4])
+                    for e in rows]
+    def setOrdered(self, oid, valueOids):
+        self.gcBarrier(valueOids)
+        self.refcountUpdate(oid, valueOids)
+        if self._isPackable(valueOids):
+            rows = [(oid, None, None, None, None, 
+                sql.packedOrdered, sql.packOids(valueOids), self.ssid)]
+        else:
+            itemRefs = [(None, v) for v in valueOids]
+            if self._setMappingDelta(oid, itemRefs, True):
+                return oid
+            rows = self._mappingRows(oid, itemRefs)
+        return self._setMappingRows(oid, rows)
 
     def getMapping(self, oid):
+        cache = self._rowCache
+        if cache is not None:
+            result = cache.getMapping(oid)
+            if result is not None:
+                return result
+
         r = self.readCursor.execute(
             'select '
-            '    k_oid, k_stg_kind, k_otype, '
-            '    v_oid, v_stg_kind, v_otype '
+            '    k_oid, k_stg_kind, k_otype, k_tag, k_inline, '
+            '    v_oid, v_stg_kind, v_otype, v_tag, v_inline '
             '  from mappings_lookup where oid_host=?', (oid,))
-        return [(e[:3], e[3:]) for e in r.fetchall()]
+        rows = r.fetchall()
+        if len(rows) == 1 and rows[0][8] == sql.packedMapping:
+            return self._unpackEntries(rows[0][8], rows[0][9])
+
+        inlineEntry = self.inlineEntry
+        return [(e[0:3] if e[3] is None else inlineEntry(e[3], e[4]),
+                 e[5:8] if e[8] is None else inlineEntry(e[8], e[9]))
+                    for e in rows]
     def setMapping(self, oid, itemOids):
+        flatOids = list(chain(*itemOids))
+        self.gcBarrier(flatOids)
+        self.refcountUpdate(oid, flatOids)
+        if self._isPackable(flatOids, len(itemOids)):
+            # k_tag is set too so the row passes mappings_lookup
+            tag = sql.packedMapping
+            rows = [(oid, None, tag, None, None, 
+                tag, sql.packOids(flatOids), self.ssid)]
+        else:
+            if self._setMappingDelta(oid, itemOids, False):
+                return oid
+            rows = self._mappingRows(oid, itemOids)
+        return self._setMappingRows(oid, rows)
+
+    def _isPackable(self, refs, count=None):
+        minLen = self.packedMinLen
+        if not minLen:
+            return False
+        if count is None:
+            count = len(refs)
+        if count < minLen:
+            return False
+        for ref in refs:
+            if type(ref) is tuple:
+                return False
+        return True
+
+    def _unpackEntries(self, tag, blob):
+        rows = unpackRows(tag, blob)
+        info = self.getOidInfoMap(oid for row in rows for oid in row)
+        info[None] = None
+        return [(k if k is None else (k,)+info[k], (v,)+info[v]) 
+                    for k, v in rows if k in info and v in info]
+
+    def getOidInfoMap(self, oids, chunkSize=500):
+        """Returns {oid: (stg_kind, otype)} for the known oids among oids,
+        using a query per chunkSize oids rather than one per oid"""
+        result = {}
+        cache = self._rowCache
+        if cache is not None:
+            cacheInfo = cache.oidInfo
+            oids = set(oids)
+            for oid in list(oids):
+                info = cacheInfo.get(oid)
+                if info is not None:
+                    result[oid] = info
+                    oids.discard(oid)
+        oids = [oid for oid in set(oids) if oid is not None]
+
+        ssids = self._readSsids
+        r = self.readCursor
+        for i in xrange(0, len(oids), chunkSize):
+            chunk = oids[i:i+chunkSize]
+            r.execute(
+                'select oid, stg_kind, otype, ssid from oid_lookup_view '
+                '  where oid in (%s)' % (','.join('?'*len(chunk)),), chunk)
+            for oid, stg_kind, otype, ssid in r:
+                result[oid] = (stg_kind, otype)
+                if ssids is not None:
+                    ssids[oid] = ssid
+        return result
+
+    def _setMappingRows(self, oid, rows):
+        self._discardCachedRows(oid)
+        wbuf = self.writeBuffer
+        if wbuf is not None:
+            wbuf.mappings[oid] = rows
+            self._wbufAdded(wbuf, 1+len(rows))
+            return oid
+
         r = self.writeCursor
         r.execute(
             'delete from mappings '
             '  where oid_host=?', (oid,))
+        self._insertRows(r, rows)
+        return oid
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Reference counting
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def initRefcounts(self):
+        """Rebuilds the counts when refcounting is turned on, and marks them
+        stale when a writer without refcounting opens the store"""
+        if not self.writable:
+            return
+        if self.refcounting:
+            self._rcZero = set()
+            if self.getMetaAttr('refcounts') != 1:
+                self.refcountRebuild()
+        elif self.getMetaAttr('refcounts') == 1:
+            self.setMetaAttr('refcounts', 0)
+
+    def refcountRebuild(self):
+        sql.refcountRebuild(self.writeCursor)
+        self.setMetaAttr('refcounts', 1)
+        self.db.commit()
+
+    def refcountUpdate(self, oid, refs):
+        """Adjusts the counts of the oids oid refers to, from its persisted
+        rows to refs.  Call before the rows are rewritten."""
+        if self._rcZero is None:
+            return
+
+        delta = {}
+        for ref in refs:
+            if ref is not None and type(ref) is not tuple:
+                delta[ref] = delta.get(ref, 0) + 1
+        for ref in self._hostRefs(oid):
+            delta[ref] = delta.get(ref, 0) - 1
+        changes = [(n, ref) for ref, n in delta.iteritems() if n]
+        if not changes:
+            return
+
+        r = self.directCursor
+        r.executemany(
+            'insert or ignore into refcounts values (?, 0)', 
+            [(ref,) for n, ref in changes])
+        r.executemany(
+            'update refcounts set refs=refs+? where oid=?', changes)
+        self._rcZero.update(ref for n, ref in changes if n < 0)
+
+    def _hostRefs(self, oid):
+        wbuf = self._wbuf
+        rows = wbuf.mappings.get(oid) if wbuf is not None else None
+        if rows is not None:
+            rows = [(e[1], e[4], e[5], e[6]) for e in rows]
+        else:
+            rows = self._cursor.execute(
+                'select oid_key, oid_value, v_tag, v_inline from mappings '
+                '  where oid_host=?', (oid,)).fetchall()
+
+        refs = []
+        for oid_key, oid_value, tag, blob in rows:
+            if tag in sql.packedTags:
+                refs.extend(sql.unpackOids(blob))
+                continue
+            if oid_key is not None:
+                refs.append(oid_key)
+            if oid_value is not None:
+                refs.append(oid_value)
+        return refs
+
+    def refcountReclaim(self, chunkSize=500):
+        """Removes the unexported oids whose count dropped to zero, and
+        then those their removal leaves at zero"""
+        r = self.writeCursor
+        nReclaimed = 0
+        while self._rcZero:
+            pending = list(self._rcZero)
+            self._rcZero = set()
+            for i in xrange(0, len(pending), chunkSize):
+                chunk = pending[i:i+chunkSize]
+                dead = [oid for oid, in r.execute(
+                    'select oid from refcounts '
+                    '  where oid in (%s) and refs <= 0 '
+                    '    and oid not in (select oid_ref from exports)' % (
+                        ','.join('?'*len(chunk)),), chunk)]
+                if dead:
+                    for oid in dead:
+                        self.refcountUpdate(oid, ())
+                    nReclaimed += self.sweepOids(r, dead)
+        return nReclaimed
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Delta container writes
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def _setMappingDelta(self, oid, itemRefs, ordered):
+        """Writes only the rows of oid that differ from its persisted rows.
+        Returns False when the container should be rewritten whole."""
+        minLen = self.deltaMinLen
+        if not minLen or len(itemRefs) < minLen:
+            return False
+
+        wbuf = self._wbuf
+        if wbuf is not None and oid in wbuf.mappings:
+            # pending rows are rewritten whole on flush anyway
+            return False
+        r = self.directCursor
+        if r is None:
+            return False
+
+        old = r.execute(
+            'select tidx, oid_key, k_tag, k_inline, '
+            '    oid_value, v_tag, v_inline from mappings '
+            '  where oid_host=? order by tidx', (oid,)).fetchall()
+        if not old or old[0][5] in sql.packedTags:
+            return False
 
+        rowRef = self._rowRef
+        old = [(e[0], rowRef(*e[1:4]), rowRef(*e[4:7])) for e in old]
+        self._discardCachedRows(oid)
+        if ordered:
+            self._orderedDelta(r, oid, old, [v for k, v in itemRefs])
+        else: self._mappingDelta(r, oid, old, itemRefs)
+        return True
+
+    def _rowRef(self, oid, tag, inline):
+        if tag is None:
+            return oid
+        return (tag, self.inlineEntry(tag, inline)[-1])
+
+    def _orderedDelta(self, r, oid, old, refs):
+        count = min(len(old), len(refs))
+        idx = 0
+        while idx < count and old[idx][2] == refs[idx]:
+            idx += 1
+
+        if len(old) == len(refs):
+            self._updateRows(r, [(e[0], ref) 
+                for e, ref in zip(old[idx:], refs[idx:]) if e[2] != ref])
+            return
+
+        # tidx ascends with element order, so a truncation is a range
+        # delete, and rows inserted afterward sort after the kept prefix
+        if idx < len(old):
+            r.execute(
+                'delete from mappings '
+                '  where oid_host=? and tidx>=?', (oid, old[idx][0]))
+        self._insertRows(r, self._mappingRows(oid, 
+                ((None, v) for v in refs[idx:])))
+
+    def _mappingDelta(self, r, oid, old, itemRefs):
+        oldByKey = dict((k, (tidx, v)) for tidx, k, v in old)
+        updates = []; inserts = []
+        for k, v in itemRefs:
+            entry = oldByKey.pop(k, None)
+            if entry is None:
+                inserts.append((k, v))
+            elif entry[1] != v:
+                updates.append((entry[0], v))
+
+        if oldByKey:
+            r.executemany(
+                'delete from mappings '
+                '  where tidx=?', [(e[0],) for e in oldByKey.itervalues()])
+        self._updateRows(r, updates)
+        self._insertRows(r, self._mappingRows(oid, inserts))
+
+    def _updateRows(self, r, updates):
+        if not updates: 
+            return
         ssid = self.ssid
+        cols = self._refColumns
         r.executemany(
-            'insert into mappings values(NULL, ?, ?, ?, ?)',
-            ((oid, oid_k, oid_v, ssid) for oid_k, oid_v in itemOids))
-        return oid
+            'update mappings set oid_value=?, v_tag=?, v_inline=?, ssid=? '
+            '  where tidx=?', [cols(v)+(ssid, tidx) for tidx, v in updates])
+
+    def _insertRows(self, r, rows):
+        if not rows: 
+            return
+        r.executemany(
+            'insert into mappings (oid_host, oid_key, k_tag, k_inline, '
+            '    oid_value, v_tag, v_inline, ssid) '
+            '  values(?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    #~ Container queries, for containers that are not loaded
+    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    def getContainerLen(self, oid):
+        cache = self._rowCache
+        if cache is not None:
+            rows = cache.mappings.get(oid)
+            if rows is not None:
+                return len(rows)
+
+        r = self.readCursor.execute(
+            'select count(*), min(v_tag), min(length(v_inline)) '
+            '  from mappings where oid_host=?', (oid,))
+        n, tag, size = r.fetchone()
+        if n == 1 and tag in sql.packedTags:
+            n = size >> 3
+            if tag == sql.packedMapping:
+                n >>= 1
+        return n
+
+    def getOrderedSlice(self, oid, offset, count):
+        """Entries offset to offset+count of an ordered container"""
+        r = self.readCursor.execute(
+            'select oid_value, v_tag, v_inline from mappings '
+            '  where oid_host=? order by tidx limit ? offset ?', 
+            (oid, count, offset))
+        rows = self._pageRows(oid, r.fetchall(), offset, count)
+        return self._pageEntries([v for k, v in rows])
+
+    def getMappingKeys(self, oid, offset, count):
+        """Key entries offset to offset+count of a mapping"""
+        r = self.readCursor.execute(
+            'select oid_key, k_tag, k_inline from mappings '
+            '  where oid_host=? order by tidx limit ? offset ?', 
+            (oid, count, offset))
+        rows = self._pageRows(oid, r.fetchall(), offset, count)
+        return self._pageEntries([k for k, v in rows])
+
+    def _pageRows(self, oid, rows, offset, count):
+        # a packed container is a single row, so look for one whenever the 
+        # page is that row or the offset skipped past it
+        if rows and rows[0][1] not in sql.packedTags:
+            return [(e, e) for e in rows]
+        if not rows and not offset:
+            return []
+
+        r = self.readCursor.execute(
+            'select v_tag, v_inline from mappings '
+            '  where oid_host=? and v_tag in (?, ?)', (oid,)+sql.packedTags)
+        e = r.fetchone()
+        if e is None: 
+            return []
+        rows = unpackRows(e[0], e[1])[offset:offset+count]
+        return [((k, None, None), (v, None, None)) for k, v in rows]
+
+    def _pageEntries(self, refs):
+        info = self.getOidInfoMap(oid for oid, tag, value in refs if tag is None)
+        inlineEntry = self.inlineEntry
+        entries = []
+        for oid, tag, value in refs:
+            if tag is not None:
+                entries.append(inlineEntry(tag, value))
+            elif oid in info:
+                entries.append((oid,)+info[oid])
+        return entries
+
+    def getMappingValue(self, oid, keyRef):
+        """Value entry stored under keyRef in a mapping, or None"""
+        where, params = self._refCondition('k', keyRef)
+        r = self.readCursor.execute(
+            'select oid_value, v_tag, v_inline from mappings as m '
+            '  where oid_host=? and (%s) limit 1' % (where,), (oid,)+params)
+        entries = self._pageEntries(r.fetchall())
+        if entries:
+            return entries[0]
+
+        for k, v in self._packedRefs(oid, sql.packedMapping, keyRef):
+            info = self.getOidInfo(v)
+            if info is not None:
+                return (v,)+info
+
+    def hasOrderedValue(self, oid, valueRef):
+        """True if an ordered container holds valueRef"""
+        where, params = self._refCondition('v', valueRef)
+        r = self.readCursor.execute(
+            'select 1 from mappings as m '
+            '  where oid_host=? and (%s) limit 1' % (where,), (oid,)+params)
+        if r.fetchone() is not None:
+            return True
+        for e in self._packedRefs(oid, sql.packedOrdered, valueRef):
+            return True
+        return False
+
+    _inlineMatchTags = {
+        'bool': ('bool', 'int', 'float'),
+        'int': ('bool', 'int', 'float'),
+        'float': ('bool', 'int', 'float'),
+        'str': ('str', 'unicode'),
+        'unicode': ('str', 'unicode'), }
+
+    def _inlineMatchTagsFor(self, tag, value):
+        tags = self._inlineMatchTags[tag]
+        if tag in ('str', 'unicode'):
+            # only ascii text compares equal between str and unicode
+            try:
+                value.encode('ascii')
+            except UnicodeError:
+                tags = (tag,)
+        return tags
+
+    def _refCondition(self, col, ref):
+        """SQL condition matching ref in the key ('k') or value ('v') columns
+        of mappings as m, and its parameters.  Inline values match inline
+        rows and literal oids holding an equal value."""
+        oidCol = 'oid_key' if col == 'k' else 'oid_value'
+        if type(ref) is not tuple:
+            return 'm.%s=?' % (oidCol,), (ref,)
+
+        tag, value = ref
+        tags = self._inlineMatchTagsFor(tag, value)
+        value = self.encodeLiteral(value, tag)
+        qtags = ','.join('?'*len(tags))
+        where = ('(m.%s_tag in (%s) and m.%s_inline=?) or exists ('
+                 '  select 1 from literals as l where l.oid=m.%s '
+                 '    and l.value_type in (%s) and l.value=?)' % (
+                    col, qtags, col, oidCol, qtags))
+        return where, tags+(value,)+tags+(value,)
+
+    def _packedRefs(self, oid, tag, ref):
+        """Yields the (oid_key, oid_value) rows of a packed container whose
+        key, for mappings, or value, for ordered, matches ref"""
+        r = self.readCursor.execute(
+            'select v_inline from mappings '
+            '  where oid_host=? and v_tag=?', (oid, tag))
+        e = r.fetchone()
+        if e is None:
+            return
+
+        if type(ref) is tuple:
+            vtag, value = ref
+            tags = self._inlineMatchTagsFor(vtag, value)
+            r = self.readCursor.execute(
+                'select oid from literals where value_type in (%s) and value=?' % (
+                    ','.join('?'*len(tags)),), tags+(self.encodeLiteral(value, vtag),))
+            oids = set(e[0] for e in r.fetchall())
+        else: oids = set([ref])
+
+        col = 1 if tag == sql.packedOrdered else 0
+        for row in unpackRows(tag, e[0]):
+            if row[col] in oids:
+                yield row
 
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
     #~ Garbage collection
     #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+    # Collector run by gcCollect: 'sql' iterates the set based queries of
+    # sqlScripts, any other name selects an engine from gcEngines.  The
+    # engine of the last collection is kept in gcLast for its timings.
+    gcMode = 'sql'
+    gcLast = None
+
+    # Milliseconds of incremental collection run per registry idle tick.
+    # Set to 0 or None to leave idle ticks alone.  gcStepMode names the
+    # engine run a step at a time: 'incremental', or 'concurrent' to mark
+    # on a second connection while this one keeps writing.
+    gcIdleBudget = None
+    gcStepMode = 'incremental'
+    _gcIncremental = None
+    _gcWrites = 0
+    _gcIdleWrites = None
+
     def gcInit(self):
         self.gcRestart()
 
@@ -388,12 +1777,69 @@ class SQLStorage(object):
         return r
 
     def gcCollect(self):
-        self.gcRestart()
-        return self.gcFlush()
+        engine = gcEngines.get(self.gcMode)
+        if engine is not None:
+            engine = engine(self)
+            self.gcLast = engine
+            result = engine.collect()
+        else:
+            self.gcRestart()
+            result = self.gcFlush()
+
+        self.gcCollected(result)
+        return result
+
+    def gcCollected(self, result):
+        # the sweep does not adjust the counts of oids the garbage referred to
+        if result and result[0] and self._rcZero is not None:
+            self.refcountRebuild()
 
     def gcIter(self, r):
         return sql.gcIter(r)
 
+    def gcIdle(self):
+        """Runs a gcIdleBudget slice of incremental collection, starting a
+        new collection only when there were writes since the last one.
+        Returns True while the collection has more work to do."""
+        budget = self.gcIdleBudget
+        if not budget:
+            return False
+        if self._gcIncremental is None:
+            if self._gcIdleWrites == self._gcWrites:
+                return False
+            self._gcIdleWrites = self._gcWrites
+        return self.gcStep(budget * 0.001)
+
+    def gcStep(self, budget=None):
+        """Runs the incremental collection for budget seconds, or to the
+        end when budget is None"""
+        engine = self._gcIncremental
+        if engine is None:
+            engine = gcEngines[self.gcStepMode](self)
+            self._gcIncremental = engine
+
+        try:
+            if engine.step(budget):
+                return True
+        except Exception:
+            # a failed collection is dropped, so the next step starts over
+            engine.abandon()
+            self._gcIncremental = None
+            raise
+        self._gcIncremental = None
+        self.gcLast = engine
+        self.gcCollected((engine.nCollected, engine.count))
+        return False
+
+    def gcBarrier(self, refs):
+        """Write barrier: shades the oids a write refers to while an
+        incremental collection is in progress"""
+        self._gcWrites += 1
+        engine = self._gcIncremental
+        if engine is not None:
+            engine.shade([ref for ref in refs 
+                if ref is not None and type(ref) is not tuple])
+
     def gcReap(self, r):
         self.db.commit()
         count, = r.execute('''select count(oid) from oidGraphMembers;''').fetchone()
@@ -406,7 +1852,46 @@ class SQLStorage(object):
             if nCollected: 
                 sql.deleteGarbage(r)
                 self.db.commit()
+                self.gcDiscardCaches()
+                self.invalidateOids()
 
         self.gcRestart()
         return nCollected, count
 
+    def sweepOids(self, cur, oids):
+        """Deletes the rows of the garbage oids, forgetting any cached state
+        for them; returns the number of oids removed"""
+        marks = ','.join('?'*len(oids))
+        cache = self._literalCache
+        if cache is not None:
+            r = cur.execute(
+                'select oid, value_type, value_hash from literals '
+                '  where oid in (%s)' % (marks,), oids)
+            for oid, value_type, value_hash in r.fetchall():
+                cache.discard(value_type, value_hash, oid)
+
+        r = cur.execute(
+            'delete from oid_lookup_raw where oid in (%s)' % (marks,), oids)
+        nCollected = max(0, r.rowcount)
+        for table, col in self._sweepTables:
+            cur.execute(
+                'delete from %s where %s in (%s)' % (table, col, marks), oids)
+
+        for oid in oids:
+            self._discardCachedRows(oid)
+        self.forgetOids(oids)
+        self.invalidateOids(oids)
+        return nCollected
+
+    _sweepTables = [
+        ('literals', 'oid'),
+        ('weakrefs', 'oid_host'),
+        ('mappings', 'oid_host'),
+        ('externals', 'oid'),
+        ('refcounts', 'oid'),
+        ]
+
+    def gcDiscardCaches(self):
+        self.clearRowCache()
+        self._literalCache = None
+
@@ -127,6 +127,14 @@ if __name__=='__main__':
             tdelta = (time.time() - tstart) or 1
             print 'gcCollect seconds: %1.1f,  oid/sec: %.0f,  cull: %s rooted: %s ' % (tdelta, (n+c)/tdelta, n, c)
 
+        if oreg is not None:
+            oreg.stg.gcMode = 'bitmap'
+            tstart = time.time()
+            n,c = oreg.gcCollect()
+            tdelta = (time.time() - tstart) or 1
+            print 'gcCollect[bitmap] seconds: %1.1f,  oid/sec: %.0f,  cull: %s rooted: %s ' % (tdelta, (n+c)/tdelta, n, c)
+            print '   ', ',  '.join('%s: %1.2f' % e for e in oreg.stg.gcLast.timings)
+
     if oreg is not None:
         oreg.commit()
         oreg.close()
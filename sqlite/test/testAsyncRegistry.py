@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+##~ Copyright (C) 2002-2007  TechGame Networks, LLC.              ##
+##~                                                               ##
+##~ This library is free software; you can redistribute it        ##
+##~ and/or modify it under the terms of the BSD style License as  ##
+##~ found in the LICENSE file included with this distribution.    ##
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Imports
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import os
+import sys
+import traceback
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Definitions
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class TestObject(object):
+    def __init__(self, i):
+        self.i = i
+
+class Unstorable(object):
+    def __getstate__(self):
+        raise ValueError("not storable")
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Main
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+if __name__=='__main__':
+    if asyncio is None:
+        print 'skipped: needs asyncio, or trollius on python 2'
+        sys.exit(0)
+
+    from TG.objdbs.sqlite.asyncRegistry import AsyncSQLObjectRegistry
+
+    dbname = 'db_testAsyncRegistry.db'
+    if os.path.exists(dbname):
+        os.remove(dbname)
+
+    loop = asyncio.new_event_loop()
+    run = loop.run_until_complete
+
+    oreg = AsyncSQLObjectRegistry(dbname, loop=loop)
+    names = ['obj%d' % i for i in xrange(50)]
+    run(asyncio.gather(loop=loop, *[oreg.store(TestObject(i), name)
+            for i, name in enumerate(names)]))
+    run(oreg.commit())
+
+    # loads issued in one pass of the loop run as a single batch
+    nBatches = [0]
+    runBatch = oreg._t_runBatch
+    def countBatch(batch):
+        nBatches[0] += 1
+        return runBatch(batch)
+    oreg._t_runBatch = countBatch
+
+    objs = run(asyncio.gather(loop=loop, *[oreg.load(name) for name in names]))
+    print 'gather load:', [o.i for o in objs] == range(len(names)), 'batches:', nBatches[0]
+
+    pxy = run(oreg.load('obj1', None, 0))
+    obj = run(oreg.fault(pxy))
+    print 'fault:', type(obj) is TestObject, obj.i == 1
+
+    run(oreg.store(Unstorable(), 'bad'))
+    future = oreg.commit()
+    try:
+        run(future)
+    except ValueError:
+        frame = traceback.extract_tb(sys.exc_info()[2])[-1]
+        print 'error:', frame[2] == '__getstate__'
+    else:
+        print 'error: not raised'
+
+    oreg.close()
+    loop.close()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+##~ Copyright (C) 2002-2007  TechGame Networks, LLC.              ##
+##~                                                               ##
+##~ This library is free software; you can redistribute it        ##
+##~ and/or modify it under the terms of the BSD style License as  ##
+##~ found in the LICENSE file included with this distribution.    ##
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Imports
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import os
+import time
+import random
+from TG.objdbs.sqlite import SQLObjectRegistry
+from TG.objdbs.sqlite.btree import PersistentBTree, BTreeBucket, BTreeNode
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Definitions
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class TestObject(object):
+    def __init__(self, i):
+        self.i = i
+
+def loadedBuckets(oreg):
+    oidToObj = oreg.stg.oidToObj
+    return sum(1 for oid in oidToObj._woids.keys()
+        if type(oidToObj.peek(oid)) in (BTreeBucket, BTreeNode))
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Main
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+if __name__=='__main__':
+    dbname = 'db_testBTree.db'
+    count = 100000
+    if os.path.exists(dbname):
+        os.remove(dbname)
+
+    rnd = random.Random(42)
+    model = dict((i*3, 'v%d' % i) for i in xrange(count))
+    model[-1] = TestObject(-1)
+
+    print 'storing', len(model), 'entries'
+    tstart = time.time()
+    oreg = SQLObjectRegistry(dbname)
+    oreg.store(PersistentBTree(model), 'index')
+    oreg.commit()
+    oreg.close()
+    print '  seconds: %1.2f' % (time.time() - tstart,)
+
+    oreg = SQLObjectRegistry(dbname)
+    tree = oreg.load('index')
+    print 'len:', len(tree), len(tree) == len(model)
+
+    tstart = time.time()
+    print 'lookup:', tree[3000] == model[3000], tree[-1].i == -1
+    print '  buckets loaded: %s  seconds: %1.4f' % (loadedBuckets(oreg), time.time() - tstart)
+
+    print 'range:', tree.keys(3000, 3030) == [k for k in sorted(model) if 3000 <= k <= 3030]
+    print '  buckets loaded:', loadedBuckets(oreg)
+
+    tree[3001] = 'new'
+    model[3001] = 'new'
+    oreg.commit()
+    print 'insert commit:', oreg.commitStats()
+
+    for n in xrange(5000):
+        key = rnd.randrange(-10, count*3+10)
+        if rnd.random() < 0.4 and key in model:
+            del tree[key]
+            del model[key]
+        else:
+            tree[key] = model[key] = n
+    oreg.commit()
+    print 'random ops commit:', oreg.commitStats()
+    print '  buckets loaded:', loadedBuckets(oreg)
+    oreg.close()
+
+    oreg = SQLObjectRegistry(dbname)
+    tree = oreg.load('index')
+    keys = tree.keys()
+    print 'reloaded:', len(tree) == len(model), keys == sorted(model)
+    print '  values:', all(model[k] == v for k, v in tree.iteritems() if k != -1)
+
+    print 'gcCollect:', oreg.gcCollect()
+    oreg.commit()
+    oreg.close()
+
+    oreg = SQLObjectRegistry(dbname)
+    tree = oreg.load('index')
+    print 'after gc:', tree.keys() == keys, tree[-1].i == -1
+    oreg.close()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+##~ Copyright (C) 2002-2007  TechGame Networks, LLC.              ##
+##~                                                               ##
+##~ This library is free software; you can redistribute it        ##
+##~ and/or modify it under the terms of the BSD style License as  ##
+##~ found in the LICENSE file included with this distribution.    ##
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Imports
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import os
+from TG.objdbs.sqlite import SQLObjectRegistry
+from TG.objdbs.sqlite.sqlStorage import SQLStorage, WriteConflict
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Definitions
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class TestObject(object):
+    def __init__(self, name, i):
+        self.name = name
+        self.i = i
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Main
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+if __name__=='__main__':
+    dbname = 'db_testMultiWriter.db'
+    for ext in ('', '-wal', '-shm'):
+        if os.path.exists(dbname+ext):
+            os.remove(dbname+ext)
+
+    SQLStorage.multiWriter = True
+    SQLStorage.oidLeaseSize = 50
+
+    oreg = SQLObjectRegistry(dbname)
+    oreg.store({'n': 0}, 'root')
+    oreg.commit()
+    oreg.close()
+
+    # two sessions taking turns at a write transaction, each storing
+    # through several oid leases
+    a = SQLObjectRegistry(dbname)
+    b = SQLObjectRegistry(dbname)
+    oids = {'a': set(), 'b': set()}
+    count = 200; batch = 40
+    for start in xrange(0, count, batch):
+        for name, oreg in (('a', a), ('b', b)):
+            for i in xrange(start, start+batch):
+                oids[name].add(oreg.store(TestObject(name, i), '%s%d' % (name, i)))
+            oreg.commit()
+    print 'leases disjoint:', not (oids['a'] & oids['b'])
+
+    # both load root; a commits a change; b then exports its stale copy
+    ra = a.load('root')
+    rb = b.load('root')
+    ra['n'] = 1
+    a.store(ra, 'root')
+    a.commit()
+
+    b.store(rb, 'root')
+    try:
+        b.commit()
+    except WriteConflict, e:
+        print 'write conflict:', True, len(e.oids)
+    else:
+        print 'write conflict:', False
+
+    rb = b.load('root')
+    print 'reloaded:', rb['n'] == 1
+    rb['n'] = 2
+    b.store(rb, 'root')
+    b.commit()
+    a.close(); b.close()
+
+    oreg = SQLObjectRegistry(dbname)
+    print 'root:', oreg.load('root')['n'] == 2
+    objs = [oreg.load('%s%d' % (name, i)) for name in 'ab' for i in xrange(count)]
+    print 'objects:', all(o.name == name and o.i == i for o, (name, i) in
+            zip(objs, [(name, i) for name in 'ab' for i in xrange(count)]))
+    oreg.close()
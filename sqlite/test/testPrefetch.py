@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+##~ Copyright (C) 2002-2007  TechGame Networks, LLC.              ##
+##~                                                               ##
+##~ This library is free software; you can redistribute it        ##
+##~ and/or modify it under the terms of the BSD style License as  ##
+##~ found in the LICENSE file included with this distribution.    ##
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Imports
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import os
+from TG.objdbs.sqlite import SQLObjectRegistry
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Definitions
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class TestObject(object):
+    def __init__(self, i):
+        self.i = i
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Main
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+if __name__=='__main__':
+    dbname = 'db_testPrefetch.db'
+    if os.path.exists(dbname):
+        os.remove(dbname)
+
+    # a list of packedMinLen or more oids is stored as one packed row
+    count = 100
+    oreg = SQLObjectRegistry(dbname)
+    root = oreg.store({'big': [TestObject(i) for i in xrange(count)]}, 'root')
+    oreg.commit()
+
+    stg = oreg.stg
+    print 'packed:', count >= stg.packedMinLen
+
+    # the root and the list are hosts within 2 hops; the members of the
+    # packed list are reached at the second hop
+    cache = oreg._tcall(stg.prefetch, root, 2)
+    hosts = [oid for oid in cache.mappings if cache.mappings[oid]]
+    print 'hosts:', len(hosts) == 2, 'oids:', len(cache.oidInfo) == count+2
+    oreg.close()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+##~ Copyright (C) 2002-2007  TechGame Networks, LLC.              ##
+##~                                                               ##
+##~ This library is free software; you can redistribute it        ##
+##~ and/or modify it under the terms of the BSD style License as  ##
+##~ found in the LICENSE file included with this distribution.    ##
+##~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~##
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Imports
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import os
+import weakref
+from TG.objdbs.sqlite import SQLObjectRegistry
+from TG.objdbs.sqlite.oidMappings import getSizeOf
+from TG.objdbs.sqlite.deserialize import ObjectDeserializer
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Definitions
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class TestObject(object):
+    def __init__(self, i):
+        self.i = i
+
+# bytes per unloaded ref measured the same way with the ObjOidRef that
+# kept its attributes in a __dict__, on 64 bit python 2.7
+dictRefBytes = 512
+
+def refBytes(pxy):
+    """Bytes of the scaffolding for one unloaded object: its proxy, its
+    ObjOidRef, and the ref's __dict__ and weakref to the proxy if any"""
+    oidRef = pxy.__getProxy__()
+    total = getSizeOf(pxy) + getSizeOf(oidRef)
+    d = getattr(oidRef, '__dict__', None)
+    if d is not None:
+        total += getSizeOf(d)
+    if type(oidRef.wrproxy) is weakref.ref:
+        total += getSizeOf(oidRef.wrproxy)
+    return total
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+#~ Main
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+if __name__=='__main__':
+    dbname = 'db_testRefMemory.db'
+    count = 10000
+
+    if not os.path.exists(dbname):
+        oreg = SQLObjectRegistry(dbname)
+        oreg.store([TestObject(i) for i in xrange(count)], 'objs')
+        oreg.commit()
+        oreg.close()
+
+    print 'baseline, __dict__ ObjOidRef:       bytes per ref: %.1f' % (dictRefBytes,)
+    for singleProxy in (False, True):
+        ObjectDeserializer.singleProxy = singleProxy
+        oreg = SQLObjectRegistry(dbname)
+        objs = oreg.load('objs', 2)
+        pxys = [e for e in objs if e.__getProxy__().ref is None]
+        total = sum(refBytes(pxy) for pxy in pxys)
+
+        print 'singleProxy: %-5s unloaded: %s  bytes per ref: %.1f' % (
+                singleProxy, len(pxys), float(total)/max(len(pxys), 1))
+
+        del objs, pxys
+        oreg.close()
+    ObjectDeserializer.singleProxy = False